@@ -12,6 +12,19 @@ from flatland.core.env_observation_builder import ObservationBuilder
 from flatland.envs.agent_utils import RailAgentStatus, EnvAgent
 
 from cnn_globalobs.utils import convert_transitions_map
+from src.rail_cache import get_rail_cache
+
+
+# Name of obs_rail in map artifacts
+RAIL_OBS_ARTIFACT = 'global_observations.rail_obs'
+
+
+def compute_rail_obs(rail):
+    """
+    :param rail: GridTransitionMap of the env
+    :return: obs_rail of CustomGlobalObsForRailEnv, np.array of shape (env.height, env.width, 2)
+    """
+    return convert_transitions_map(get_rail_cache(rail).rail_planes)
 
 
 class CustomGlobalObsForRailEnv(ObservationBuilder):
@@ -34,21 +47,22 @@ class CustomGlobalObsForRailEnv(ObservationBuilder):
          target and the positions of the other agents targets (flag only, no counter!).
     """
 
-    def __init__(self):
+    def __init__(self, map_artifacts=None):
         super(CustomGlobalObsForRailEnv, self).__init__()
+        # MapArtifacts with the precomputed structures of fixed maps (and obs_rail), loaded at reset()
+        self.map_artifacts = map_artifacts
 
     def set_env(self, env: Environment):
         super().set_env(env)
 
     def reset(self):
-        rail_obs_16_channels = np.zeros((self.env.height, self.env.width, 16))
-        for i in range(rail_obs_16_channels.shape[0]):
-            for j in range(rail_obs_16_channels.shape[1]):
-                bitlist = [int(digit) for digit in bin(self.env.rail.get_full_transitions(i, j))[2:]]
-                bitlist = [0] * (16 - len(bitlist)) + bitlist
-                rail_obs_16_channels[i, j] = np.array(bitlist)
-
-        self.rail_obs = convert_transitions_map(rail_obs_16_channels)
+        artifact = None
+        if self.map_artifacts is not None:
+            artifact = self.map_artifacts.load(self.env.rail, self.env.agents)
+        if artifact is not None and RAIL_OBS_ARTIFACT in artifact:
+            self.rail_obs = artifact.get(RAIL_OBS_ARTIFACT)
+        else:
+            self.rail_obs = compute_rail_obs(self.env.rail)
 
     def get(self, handle: int = 0) -> (np.ndarray, np.ndarray, np.ndarray):
 
@@ -55,15 +55,15 @@ def compute_all_possible_transitions():
 # see rail_env_grid.py
 def convert_transitions_map(obs_transitions_map):
 
-    new_transitions_map = np.zeros((obs_transitions_map.shape[0], obs_transitions_map.shape[1], 2))
     possible_transitions_dict = compute_all_possible_transitions()
 
-    for i in range(obs_transitions_map.shape[0]):
-        for j in range(obs_transitions_map.shape[1]):
-            transition_bitmap = obs_transitions_map[i, j]
-            # Convert bitmap to int binario
-            int_transition_bitmap = int(transition_bitmap.dot(2 ** np.arange(transition_bitmap.size)[::-1]))
-            new_transitions_map[i, j] = possible_transitions_dict[int_transition_bitmap]
+    # Convert bitmaps to int (packing the bit planes), then look up each distinct bitmap only once
+    int_transitions_map = np.packbits(np.asarray(obs_transitions_map, dtype=np.uint8), axis=2)
+    int_transitions_map = int_transitions_map[:, :, 0].astype(int) << 8 | int_transitions_map[:, :, 1]
+    int_transition_bitmaps, cells_bitmap = np.unique(int_transitions_map, return_inverse=True)
+    cell_types = np.array([possible_transitions_dict[int_transition_bitmap]
+                           for int_transition_bitmap in int_transition_bitmaps.tolist()], dtype=float).reshape((-1, 2))
+    new_transitions_map = cell_types[cells_bitmap.reshape(int_transitions_map.shape)]
 
     return new_transitions_map
 
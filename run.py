@@ -9,6 +9,7 @@ from flatland.evaluators.client import FlatlandRemoteClient  # For evaluation
 
 from src.graph_observations import GraphObsForRailEnv
 from src.predictions import ShortestPathPredictorForRailEnv
+from src.map_artifacts import MapArtifacts
 from src.dueling_double_dqn import Agent
 import src.nets
 
@@ -18,7 +19,10 @@ sys.path.append(str(base_dir))
 remote_client = FlatlandRemoteClient()  # Init remote client for eval
 
 prediction_depth = 40
-observation_builder = GraphObsForRailEnv(bfs_depth=4, predictor=ShortestPathPredictorForRailEnv(max_depth=prediction_depth))
+# Structures of the test-envs levels precomputed by src/build_map_artifacts.py, if any
+map_artifacts = MapArtifacts(Path(__file__).resolve().parent / 'map-artifacts')
+observation_builder = GraphObsForRailEnv(bfs_depth=4, predictor=ShortestPathPredictorForRailEnv(max_depth=prediction_depth, incremental=True),
+                                         only_action_required=True, map_artifacts=map_artifacts)
 
 
 state_size = prediction_depth + 5
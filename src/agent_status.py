@@ -0,0 +1,64 @@
+"""
+Index of the agents status, refreshed once per step and shared by observation builders and controllers, so that
+counters like the number of active or malfunctioning agents are not recomputed scanning all agents for each handle.
+"""
+
+import numpy as np
+
+from flatland.envs.agent_utils import RailAgentStatus
+
+from src.utils import is_action_required
+
+
+class AgentStatusIndex:
+    """
+    Per-step snapshot of the agents status:
+
+    - status: np.array of shape (num_agents,) with the RailAgentStatus of each agent (as int)
+    - malfunction: np.array of shape (num_agents,) with the remaining malfunction duration of each agent
+    - speed: np.array of shape (num_agents,) with the fractional speed of each agent
+    - action_required: np.array of shape (num_agents,), True if the agent has to pick an action
+    - handles: dict RailAgentStatus : set of handles of agents with that status
+    - malfunctioning: set of handles of agents currently malfunctioning
+    """
+
+    def __init__(self):
+        self.status = np.zeros(0, dtype=int)
+        self.malfunction = np.zeros(0, dtype=int)
+        self.speed = np.zeros(0)
+        self.action_required = np.zeros(0, dtype=bool)
+        self.handles = {status: set() for status in RailAgentStatus}
+        self.malfunctioning = set()
+
+    def update(self, agents):
+        """
+        Refresh the index, must be called once per step (e.g. at the beginning of get_many()).
+        :param agents: env.agents
+        :return:
+        """
+        self.status = np.array([a.status for a in agents], dtype=int)
+        self.malfunction = np.array([a.malfunction_data['malfunction'] for a in agents], dtype=int)
+        self.speed = np.array([a.speed_data['speed'] for a in agents], dtype=float)
+        self.action_required = np.array([is_action_required(a) for a in agents], dtype=bool)
+        self.handles = {status: set(np.flatnonzero(self.status == status).tolist()) for status in RailAgentStatus}
+        self.malfunctioning = set(np.flatnonzero(self.malfunction != 0).tolist())
+
+    @property
+    def active(self):
+        return self.handles[RailAgentStatus.ACTIVE]
+
+    @property
+    def ready_to_depart(self):
+        return self.handles[RailAgentStatus.READY_TO_DEPART]
+
+    @property
+    def num_active(self):
+        return len(self.handles[RailAgentStatus.ACTIVE])
+
+    @property
+    def num_ready_to_depart(self):
+        return len(self.handles[RailAgentStatus.READY_TO_DEPART])
+
+    @property
+    def num_malfunctioning(self):
+        return len(self.malfunctioning)
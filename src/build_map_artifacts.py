@@ -0,0 +1,42 @@
+import sys
+import argparse
+import glob
+# make sure the root path is in system path
+from pathlib import Path
+# These 2 lines must go before the import from src/
+base_dir = Path(__file__).resolve().parent.parent
+sys.path.append(str(base_dir))
+
+from flatland.envs.rail_env import RailEnv
+from flatland.envs.rail_generators import rail_from_file
+from flatland.envs.schedule_generators import schedule_from_file
+
+from cnn_globalobs.global_observations import compute_rail_obs, RAIL_OBS_ARTIFACT
+from src.map_artifacts import MapArtifacts
+
+
+def main(args):
+    map_artifacts = MapArtifacts(args.output)
+    files = sorted(set(file for pattern in args.maps for file in glob.glob(str(base_dir / pattern))))
+    for file in files:
+        # Same as the evaluation service, the env takes size and agents from the file
+        env = RailEnv(width=1, height=1,
+                      rail_generator=rail_from_file(file),
+                      schedule_generator=schedule_from_file(file),
+                      number_of_agents=1)
+        env.reset()
+        path = map_artifacts.save(env.rail, env.agents, {RAIL_OBS_ARTIFACT: compute_rail_obs(env.rail)})
+        print('{} ({}x{}, {} agents) -> {}'.format(file, env.height, env.width, env.get_num_agents(), path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Precompute the map artifacts of fixed maps')
+    parser.add_argument('--maps', type=str, nargs='+',
+                        default=['test-envs/Test_*/Level_*.pkl', 'cnn_globalobs/railway/*.pkl'],
+                        help='Glob patterns of the .pkl maps, relative to the root of the repository')
+    parser.add_argument('--output', type=str, default=str(base_dir / 'map-artifacts'),
+                        help='Directory where artifacts are written, one subdirectory per map')
+
+    args = parser.parse_args()
+    main(args)
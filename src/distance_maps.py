@@ -0,0 +1,262 @@
+"""
+Distance maps of a RailEnv and lookup tables derived from them, built once per map and set of targets (i.e. at most once
+per episode) and shared by observation builders, predictors and controllers, so that following the shortest path
+doesn't require to walk it with get_shortest_paths().
+"""
+
+import weakref
+
+import numpy as np
+
+from flatland.envs.rail_env import RailEnvActions
+
+from src.rail_cache import get_rail_cache, MOVEMENTS
+
+# Distance maps of each rail (GridTransitionMap), dropped together with the rail
+_target_distance_maps = weakref.WeakKeyDictionary()
+# Next action table of each TargetDistanceMaps, dropped together with the distance maps
+_next_action_tables = weakref.WeakKeyDictionary()
+
+
+class TargetDistanceMaps:
+    """
+    Distance maps of the agents with one map per distinct target instead of one per agent (as DistanceMap.get() does),
+    since many agents usually share the same target:
+
+    - targets: np.array of shape (num_targets, 2), distinct targets of the agents
+    - agent_targets: np.array of shape (num_agents,), index of the target of each agent in targets
+    - distances: np.array of shape (num_targets, height, width, 4), number of steps from the waypoint (row, column,
+    direction) to the target, np.inf where the target can't be reached, the same values of DistanceMap.get() for the
+    agents with that target
+    - flat_distances: np.array of shape (num_targets, height * width * 4 + 1), the same distances indexed by flat
+    waypoint index (row * width + column) * 4 + direction (distances is a view of it), where the last column (index -1)
+    is np.inf
+    """
+
+    def __init__(self, rail, agents):
+        """
+        :param rail: GridTransitionMap of the env
+        :param agents: env.agents
+        """
+        # Keep a reference to the grid and the targets to detect when they are replaced
+        self.grid = rail.grid
+        self.agents_targets = tuple(tuple(agent.target) for agent in agents)
+        rail_cache = get_rail_cache(rail)
+        height, width = rail_cache.height, rail_cache.width
+
+        self.targets, self.agent_targets = np.unique(
+            np.array(self.agents_targets, dtype=int).reshape((-1, 2)), axis=0, return_inverse=True)
+        self.agent_targets = self.agent_targets.reshape(-1)
+        self.flat_distances = np.full((len(self.targets), height * width * 4 + 1), np.inf)
+        self.distances = self.flat_distances[:, :-1].reshape((len(self.targets), height, width, 4))
+        self._compute(rail_cache)
+
+    def _compute(self, rail_cache):
+        """
+        Breadth-first search backwards from all targets at once: the frontier is the array of waypoints (of all the
+        maps) reached at the current distance, the next frontier are their predecessors not reached yet, namely the
+        waypoints (cell, direction) of the previous cell that have a transition towards the frontier waypoint.
+        As in DistanceMap, targets have distance 0 for all directions.
+        :param rail_cache: RailCache of the rail
+        :return:
+        """
+        height, width = rail_cache.height, rail_cache.width
+        num_waypoints = height * width * 4
+        # Predecessors of each waypoint, as flat indices in a map, -1 if none
+        rows, cols, directions, orientations = np.meshgrid(
+            np.arange(height), np.arange(width), np.arange(4), np.arange(4), indexing='ij')
+        previous_rows = rows - MOVEMENTS[directions, 0]
+        previous_cols = cols - MOVEMENTS[directions, 1]
+        is_inside = (previous_rows >= 0) & (previous_rows < height) & (previous_cols >= 0) & (previous_cols < width)
+        previous_rows, previous_cols = np.clip(previous_rows, 0, height - 1), np.clip(previous_cols, 0, width - 1)
+        is_predecessor = is_inside & rail_cache.transitions[previous_rows, previous_cols, orientations, directions]\
+            .astype(bool)
+        predecessors = np.where(is_predecessor, (previous_rows * width + previous_cols) * 4 + orientations, -1)
+        predecessors = predecessors.reshape((num_waypoints, 4))
+
+        # Maps are rows of flat_distances, waypoints of all maps are indexed as map * map_size + waypoint
+        map_size = num_waypoints + 1
+        distances = self.flat_distances.reshape(-1)
+        frontier = (np.arange(len(self.targets))[:, np.newaxis] * map_size +
+                    ((self.targets[:, 0] * width + self.targets[:, 1]) * 4)[:, np.newaxis] + np.arange(4)).reshape(-1)
+        distances[frontier] = 0
+        distance = 0
+        while len(frontier) > 0:
+            distance += 1
+            map_offsets, waypoints = np.divmod(frontier, map_size)
+            previous = predecessors[waypoints]
+            frontier = (previous + map_offsets[:, np.newaxis] * map_size)[previous != -1]
+            frontier = np.unique(frontier[distances[frontier] == np.inf])
+            distances[frontier] = distance
+
+    def get(self, handle):
+        """
+        :param handle: agent id
+        :return: np.array of shape (height, width, 4), distance map of the agent (not to be modified)
+        """
+        return self.distances[self.agent_targets[handle]]
+
+
+def get_target_distance_maps(rail, agents):
+    """
+    Return the TargetDistanceMaps of the rail, they are computed the first time that this rail (or a new grid or new
+    targets for this rail) is seen, e.g. at the first reset() of an episode, and then shared by all their users.
+    :param rail: GridTransitionMap of the env
+    :param agents: env.agents
+    :return: TargetDistanceMaps
+    """
+    target_distance_maps = _target_distance_maps.get(rail)
+    if target_distance_maps is None or target_distance_maps.grid is not rail.grid or \
+            target_distance_maps.agents_targets != tuple(tuple(agent.target) for agent in agents):
+        target_distance_maps = TargetDistanceMaps(rail, agents)
+        _target_distance_maps[rail] = target_distance_maps
+    return target_distance_maps
+
+
+class NextActionTable:
+    """
+    Action that follows the shortest path towards each distinct target of the agents, from each waypoint:
+
+    - targets: np.array of shape (num_targets, 2), distinct targets of the agents
+    - agent_targets: np.array of shape (num_agents,), index of the target of each agent in targets
+    - actions: np.array of shape (num_targets, height, width, 4), RailEnvActions that an agent in (row, column) with the
+    given direction takes to follow its shortest path, the same of the first step of get_shortest_paths(), STOP_MOVING
+    at the target and -1 where there is no path
+    - next_directions: np.array of shape (num_targets, height, width, 4), direction of the agent after the action,
+    -1 at the target and where there is no path
+    """
+
+    def __init__(self, target_distance_maps, rail):
+        """
+        :param target_distance_maps: TargetDistanceMaps of the env
+        :param rail: GridTransitionMap of the env
+        """
+        rail_cache = get_rail_cache(rail)
+        height, width = rail_cache.height, rail_cache.width
+        self.targets = target_distance_maps.targets
+        self.agent_targets = target_distance_maps.agent_targets
+
+        # Candidate moves of get_valid_move_actions_(), in order: left, forward and right, or the U-turn in dead-ends
+        exits, is_valid = rail_cache.move_exits, rail_cache.move_mask
+        # Rows and columns of the next cells, in the distance map padded with a border of unreachable cells
+        next_rows = np.arange(height)[:, np.newaxis, np.newaxis, np.newaxis] + MOVEMENTS[exits, 0] + 1
+        next_cols = np.arange(width)[np.newaxis, :, np.newaxis, np.newaxis] + MOVEMENTS[exits, 1] + 1
+
+        # With a single possible move the action is always MOVE_FORWARD
+        is_forward_only = rail_cache.dead_end_mask[:, :, np.newaxis] | (rail_cache.transitions.sum(axis=3) == 1)
+        candidate_actions = np.array([RailEnvActions.MOVE_LEFT, RailEnvActions.MOVE_FORWARD,
+                                      RailEnvActions.MOVE_RIGHT], dtype=np.int8)
+
+        self.actions = np.full((len(self.targets), height, width, 4), -1, dtype=np.int8)
+        self.next_directions = np.full((len(self.targets), height, width, 4), -1, dtype=np.int8)
+        padded_distances = np.full((height + 2, width + 2, 4), np.inf)
+        for t, target_distances in enumerate(target_distance_maps.distances):
+            padded_distances[1:-1, 1:-1] = target_distances
+            distances = np.where(is_valid, padded_distances[next_rows, next_cols, exits], np.inf)
+            # As in get_shortest_paths() the first move with the lowest (finite) distance is chosen
+            best = np.argmin(distances, axis=3)
+            has_path = np.take_along_axis(distances, best[..., np.newaxis], axis=3)[..., 0] < np.inf
+            actions = np.where(is_forward_only, RailEnvActions.MOVE_FORWARD, candidate_actions[best])
+            self.actions[t] = np.where(has_path, actions, -1)
+            self.next_directions[t] = np.where(has_path, np.take_along_axis(exits, best[..., np.newaxis], axis=3)[..., 0],
+                                               -1)
+            target_row, target_col = self.targets[t]
+            self.actions[t, target_row, target_col] = RailEnvActions.STOP_MOVING
+            self.next_directions[t, target_row, target_col] = -1
+
+    def get_action(self, handle, position, direction):
+        """
+        :param handle: agent id
+        :param position: current cell of the agent
+        :param direction: current direction of the agent
+        :return: action to follow the shortest path of the agent, -1 if there is no path
+        """
+        return self.actions[self.agent_targets[handle], position[0], position[1], direction]
+
+    def get_actions(self, handles, positions, directions):
+        """
+        Vectorized get_action() for many agents at once.
+        :param handles: np.array of shape (num_handles,)
+        :param positions: np.array of shape (num_handles, 2)
+        :param directions: np.array of shape (num_handles,)
+        :return: np.array of shape (num_handles,) of actions, -1 where there is no path
+        """
+        return self.actions[self.agent_targets[handles], positions[:, 0], positions[:, 1], directions]
+
+
+def get_next_action_table(rail, agents):
+    """
+    Return the NextActionTable of the distance maps of the env (see get_target_distance_maps()), it is built the first
+    time that these distance maps are seen and then shared by all its users.
+    :param rail: GridTransitionMap of the env
+    :param agents: env.agents
+    :return: NextActionTable
+    """
+    target_distance_maps = get_target_distance_maps(rail, agents)
+    next_action_table = _next_action_tables.get(target_distance_maps)
+    if next_action_table is None:
+        next_action_table = NextActionTable(target_distance_maps, rail)
+        _next_action_tables[target_distance_maps] = next_action_table
+    return next_action_table
+
+
+def walk_shortest_paths(rail, agents, waypoints, is_removed, max_depth=None):
+    """
+    Batched version of get_shortest_paths(): the paths of all agents are walked at once on the distance maps of their
+    targets (see get_target_distance_maps()), one step for all agents per iteration.
+    As in get_shortest_paths(), at each step the move that leads to the first waypoint with the lowest distance (lower
+    than the one of the previous move) is chosen, the walk ends at the target, after max_depth moves, or when no move is
+    possible, i.e. there is no path.
+    :param rail: GridTransitionMap of the env
+    :param agents: env.agents
+    :param waypoints: np.array of shape (num_agents, 3), (row, column, direction) where each walk starts
+    :param is_removed: np.array of shape (num_agents,), True for agents without path (DONE_REMOVED)
+    :param max_depth: max number of moves of each path, None to walk until all agents have reached their target
+    :return: np.array of shape (num_agents, num_moves + 1, 3) with (row, column, direction) of the waypoints walked,
+    where [:, 0] is the starting waypoint and num_moves is max_depth (if not None), filled with the last waypoint of
+    each walk, np.array of shape (num_agents,) with the number of moves of each walk, np.array of shape (num_agents,)
+    False for agents without path (get_shortest_paths() returns None)
+    """
+    rail_cache = get_rail_cache(rail)
+    target_distance_maps = get_target_distance_maps(rail, agents)
+    width = rail_cache.width
+    waypoints = np.array(waypoints, dtype=int).reshape((-1, 3))
+    target_cells = target_distance_maps.targets[target_distance_maps.agent_targets]
+    target_cells = target_cells[:, 0] * width + target_cells[:, 1]
+
+    # Waypoints as flat indices, only agents still walking are moved at each step
+    waypoint = (waypoints[:, 0] * width + waypoints[:, 1]) * 4 + waypoints[:, 2]
+    has_path = ~is_removed
+    num_moves = np.zeros(len(waypoints), dtype=int)
+    walking = np.flatnonzero(has_path & (waypoint // 4 != target_cells))
+    walking_waypoints = waypoint[walking]
+    walking_distances = np.full(len(walking), np.inf)
+    walked = [waypoint]
+    while len(walking) > 0 and (max_depth is None or len(walked) <= max_depth):
+        next_waypoints = rail_cache.move_waypoints[walking_waypoints]
+        # Not valid moves (-1) have distance np.inf
+        distances = target_distance_maps.flat_distances[
+            target_distance_maps.agent_targets[walking][:, np.newaxis], next_waypoints]
+        best = np.argmin(distances, axis=1)
+        best_distances = distances[np.arange(len(walking)), best]
+        is_moving = best_distances < walking_distances
+        has_path[walking[~is_moving]] = False
+
+        walking = walking[is_moving]
+        walking_waypoints = next_waypoints[is_moving, best[is_moving]]
+        walking_distances = best_distances[is_moving]
+        waypoint = waypoint.copy()
+        waypoint[walking] = walking_waypoints
+        num_moves[walking] += 1
+        walked.append(waypoint)
+
+        is_walking = walking_waypoints // 4 != target_cells[walking]
+        walking, walking_waypoints, walking_distances = \
+            walking[is_walking], walking_waypoints[is_walking], walking_distances[is_walking]
+
+    if max_depth is not None:
+        walked.extend([waypoint] * (max_depth + 1 - len(walked)))
+    walked = np.stack(walked, axis=1)
+    cells, directions = np.divmod(walked, 4)
+    rows, cols = np.divmod(cells, width)
+    return np.stack((rows, cols, directions), axis=2), num_moves, has_path
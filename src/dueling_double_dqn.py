@@ -214,10 +214,10 @@ class ReplayBuffer:
             
         elif self.network_type == 'conv':
             if isinstance(values[0], Iterable):
-                sub_dim = len(values[0][0])
                 # Create a 1d array of states and reshape it into (batch_size, in_channels, view_width, view_height)
-                # 'states' is a list containing batch_size arrays of shape (1, in_channels, view_width, view_height)
-                np_values = np.reshape(np.array(values), (len(values), sub_dim, 15,  30)) # TODO add param env_width env_height
+                # 'states' is a list containing batch_size arrays of shape (in_channels, view_width, view_height), as
+                # returned by preprocess_obs() or by LocalObsForRailEnv with batched=True (or with a leading axis of 1)
+                np_values = np.reshape(np.array(values), (len(values),) + np.shape(values[0])[-3:])
             else:  # values are actions or rewards...
                 sub_dim = 1
                 # Create a 1d array of values and reshape it into (batch_size, in_channels)
@@ -28,6 +28,13 @@ from flatland.core.grid.grid4_utils import get_new_position
 from flatland.core.grid.grid_utils import coordinate_to_position, distance_on_rail, position_to_coordinate
 
 from src.draw_obs_graph import build_graph
+from src.predictions import PredictionStore
+from src.rail_cache import get_rail_cache
+from src.switch_graph import get_switch_graph
+from src.distance_maps import get_next_action_table
+from src.reservation_table import ReservationTable
+from src.replanning import ReplanningScheduler
+from src.agent_status import AgentStatusIndex
 from src.utils import assign_random_priority, assign_speed_priority, assign_priority
 
 
@@ -41,20 +48,34 @@ class GraphObsForRailEnv(ObservationBuilder):
                                   'agent_direction '  # Direction with which the agent arrived in this node
                                   'is_target')  # Whether agent's target is in this cell
 
-    def __init__(self, predictor):
+    def __init__(self, predictor, only_action_required=False, replan_on_events=False, map_artifacts=None):
         super(GraphObsForRailEnv, self).__init__()
         # self.bfs_depth = bfs_depth
         self.predictor = predictor
+        # MapArtifacts with the precomputed structures of fixed maps, loaded at reset(), if None they are computed
+        self.map_artifacts = map_artifacts
+        # If True get_many() recomputes observations only for agents that have to pick an action
+        self.only_action_required = only_action_required
+        # If True get_many() recomputes observations only for agents that have to pick an action or are affected by an
+        # event (see ReplanningScheduler), and predictions are walked again only for agents with an event
+        self.replan_on_events = replan_on_events
+        self.replanning = ReplanningScheduler()
         self.max_prediction_depth = 0
         self.prediction_dict = {}  # Dict handle : list of tuples representing prediction steps
-        self.predicted_pos = {}  # Dict ts : int_pos_list
-        self.predicted_pos_list = {} # Dict handle : int_pos_list
-        self.predicted_pos_coord = {}  # Dict ts : coord_pos_list
-        self.predicted_dir = {}  # Dict ts : dir (float)
+        self.predictions = PredictionStore()  # Predicted cells, int positions and directions as (num_agents, depth) arrays
+        self.reservations = ReservationTable()  # Agents predicted in each (int_pos, ts), updated once per step
+        self.predicted_cell_ids = None  # np.array of shape (num_agents, prediction_depth), ids of the predicted cells
+        self.visited_cells = None  # np.array of shape (num_agents, num_distinct_cells), True if the cell is predicted
+        self.observations = {}  # Dict handle : last observation computed
         self.num_active_agents = 0
+        self.agents_status = AgentStatusIndex()  # Refreshed once per step in get_many()
         self.cells_sequence = None
         self.env_graph = None
-        self.forks_coords = None
+        self.forks_mask = None  # np.array of shape (env.height, env.width), True if the cell is a fork
+        self.rail_cache = None
+        self.switch_graph = None  # SwitchGraph of the rail, nodes are switches, dead-ends and targets
+        self.next_action_table = None  # NextActionTable of the targets of the agents, resolved at reset()
+        self.next_actions = np.zeros(0, dtype=int)  # Shortest path action of each agent, refreshed in get_many()
         # self.overlapping_spans = {} # Dict handle : list of cells that correspond to 1 in occupancy
 
     def set_env(self, env: Environment):
@@ -73,150 +94,182 @@ class GraphObsForRailEnv(ObservationBuilder):
         for a in range(self.env.get_num_agents()):
             self.overlapping_spans.update({a: []})
         '''
-        self.forks_coords = self._find_forks()
-
-    def get_many(self, handles: Optional[List[int]] = None) -> {}:
+        if self.predictor:
+            self.predictor.reset()
+        if self.map_artifacts is not None:
+            self.map_artifacts.load(self.env.rail, self.env.agents)
+        self.rail_cache = get_rail_cache(self.env.rail)
+        self.switch_graph = get_switch_graph(self.env.rail, [agent.target for agent in self.env.agents])
+        self.next_action_table = get_next_action_table(self.env.rail, self.env.agents)
+        self.forks_mask = self._find_forks()
+        self.reservations.reset()
+        self.replanning.reset()
+        self.observations = {}
+
+    def get_many(self, handles: Optional[List[int]] = None, action_required=None) -> {}:
         """
         Compute observations for all agents in the env.
+        Observations are built in one pass into a single array of shape (len(handles), prediction_depth * 4 + 4),
+        see _get_observations_array(), the returned dict maps each handle to its row.
+        Observations of agents that don't have to pick an action are not recomputed, the last observation computed
+        for them is returned instead (never modified afterwards, so it can still be stored in replay buffers).
         :param handles: 
+        :param action_required: mask (dict or list indexed by handle) of agents that have to pick an action,
+        if None it is computed as in RailEnv info['action_required'] when only_action_required is set, otherwise
+        observations are recomputed for all agents
+        When replan_on_events is set, observations are always recomputed for agents that have to pick an action (as
+        computed in RailEnv info['action_required'] if action_required is None), while the other agents are recomputed
+        only if affected by an event since the last step (see ReplanningScheduler), and predictions are walked again
+        only for agents with an event (the others are advanced along their paths, see ShortestPathPredictorForRailEnv).
         :return: 
         """
         
-        self.num_active_agents = 0
-        for a in self.env.agents:
-            if a.status == RailAgentStatus.ACTIVE:
-                self.num_active_agents += 1
-        self.prediction_dict = self.predictor.get()
-        # Useful to check if occupancy is correctly computed
-        self.cells_sequence = self.predictor.compute_cells_sequence(self.prediction_dict)
+        self.agents_status.update(self.env.agents)
+        if self.replan_on_events:
+            self.replanning.detect_events(self.env.agents, self.agents_status, self.rail_cache.switch_mask)
+        self.num_active_agents = self.agents_status.num_active
+        self._update_next_actions()
+        if self.replan_on_events:
+            self.prediction_dict = self.predictor.get(replan_handles=self.replanning.recompute)
+        else:
+            self.prediction_dict = self.predictor.get()
 
         if self.prediction_dict:
             self.max_prediction_depth = self.predictor.max_depth
-            for t in range(self.max_prediction_depth):
-                pos_list = []
-                dir_list = []
-                for a in handles:
-                    if self.prediction_dict[a] is None:
-                        continue
-                    pos_list.append(self.prediction_dict[a][t][1:3])
-                    dir_list.append(self.prediction_dict[a][t][3])
-                self.predicted_pos_coord.update({t: pos_list})
-                self.predicted_pos.update({t: coordinate_to_position(self.env.width, pos_list)})
-                self.predicted_dir.update({t: dir_list})
-
-            for a in range(len(self.env.agents)):
-                pos_list = []
-                for ts in range(self.max_prediction_depth):
-                    pos_list.append(self.predicted_pos[ts][a])  # Use int positions
-                self.predicted_pos_list.update({a: pos_list})
-                
+            self.predictions.update(self.predictor.prediction_tensor, self.max_prediction_depth, self.env.width)
+            # Useful to check if occupancy is correctly computed
+            self.cells_sequence = self.predictions.cells
+
+            # Index agents by predicted (int position, ts), updated once per step and used to detect conflicts
+            # Agents that were or are going to be in conflict with agents with an event have to be recomputed
+            if self.replan_on_events:
+                self.replanning.add_overlapping(self.reservations)
+            self.reservations.update(self.predictions.positions)
+            if self.replan_on_events:
+                self.replanning.add_overlapping(self.reservations)
+
+            # Cells visited by each agent in its prediction as a boolean matrix of shape (num_agents, num_distinct_cells),
+            # shared by all agents to compute overlapping paths
+            predicted_pos = self.predictions.positions
+            _, cell_ids = np.unique(predicted_pos, return_inverse=True)
+            self.predicted_cell_ids = cell_ids.reshape(predicted_pos.shape)
+            self.visited_cells = np.zeros((predicted_pos.shape[0], cell_ids.max() + 1), dtype=bool)
+            self.visited_cells[np.arange(predicted_pos.shape[0])[:, np.newaxis], self.predicted_cell_ids] = True
+
+        if action_required is None and (self.only_action_required or self.replan_on_events):
+            action_required = self.agents_status.action_required
+        if action_required is None:
+            required_handles = handles
+        elif self.replan_on_events:
+            # Occupancy, forks and target layers are indexed by timesteps from now, so agents that have to pick an
+            # action always need a new obs, the others only if affected by an event
+            required_handles = [a for a in handles if action_required[a] or a not in self.observations
+                                or a in self.replanning.recompute]
+            self.replanning.recomputed_fractions.append(len(required_handles) / max(1, len(handles)))
+        else:
+            # Compute obs anyway for agents that have none yet (e.g. at the beginning of an episode)
+            required_handles = [a for a in handles if action_required[a] or a not in self.observations]
+
+        observations_array = self._get_observations_array(required_handles)
+        for i, a in enumerate(required_handles):
+            self.observations[a] = observations_array[i]
         observations = {}
         for a in handles:
-            observations[a] = self.get(a)
+            observations[a] = self.observations[a]
         return observations
 
-    # TODO Optimize considering that I don't need obs for those agents who don't have to pick actions
     def get(self, handle: int = 0) -> {}:
         """
-        TODO Update docstrings
         Returns obs for one agent, obs are a single array of concatenated values representing:
         - occupancy of next prediction_depth cells, 
         - agent priority/speed,
         - number of malfunctioning agents (encountered),
         - number of agents that are ready to depart (encountered).
+        Relies on the predictions computed in get_many().
         :param handle: 
         :return: 
         """
+        return self._get_observations_array([handle])[0]
 
-        #bfs_graph = self._bfs_graph(handle)
+    def _get_observations_array(self, handles):
+        """
+        Build observations of the agents in handles, row by row in a preallocated array, where each row is the
+        concatenation of (each layer has length prediction_depth):
+        - occupancy, first layer: counter of possible conflicts, or overlapping paths with conflicting agents,
+        - occupancy, second layer: 1 if the overlapping span was already entered by some conflicting agent,
+        - forks: 1 if the predicted cell is a fork,
+        - target: 1 if the predicted cell is the agent target,
+        - agent priority, max priority encountered, number of malfunctioning agents, number of agents ready to depart.
+        :param handles: list of agent ids
+        :return: np.array of shape (len(handles), prediction_depth * 4 + 4)
+        """
         agents = self.env.agents
-        agent = agents[handle]
+        depth = self.max_prediction_depth
+        obs = np.zeros((len(handles), depth * 4 + 4))
+        if len(handles) == 0 or depth == 0:
+            return obs
+
+        # Counters are global, hence the same for all agents
+        # Counting number of agents that are currently malfunctioning (globally) - experimental
+        # in TreeObs they store the length of the longest malfunction encountered
+        obs[:, depth * 4 + 2] = self.agents_status.num_malfunctioning
+        # Agents status (agents ready to depart) - it tells the agent how many will appear - encountered? or globally?
+        obs[:, depth * 4 + 3] = self.agents_status.num_ready_to_depart
 
-        # Occupancy
-        occupancy, conflicting_agents = self._fill_occupancy(handle)
-        # TODO This can be done inside _fill_occupancy - temp not using a second layer
-        # Augment occupancy with another one-hot encoded layer: 1 if this cell is overlapping and the conflict span was already entered by some other agent
-        
-        second_layer = np.zeros(self.max_prediction_depth, dtype=int) # Same size as occupancy
-        for ca in conflicting_agents:
-            if ca != handle:
-                # Find ts when conflict occurred
-                ts = [x for x, y in enumerate(self.cells_sequence[handle]) if y[0] == agents[ca].position[0] and y[1] == agents[ca].position[1]] # Find index/ts for conflict
-                # Set to 1 conflict span which was already entered by some agent - fill left side and right side of ts
-                if len(ts) > 0:
-                    i = ts[0] # Since the previous returns a list of ts
-                    while 0 <= i < self.max_prediction_depth:
-                        second_layer[i] = 1 if occupancy[i] > 0 else 0
-                        i -= 1
-                    i = ts[0]
-                    while i < self.max_prediction_depth:
-                        second_layer[i] = 1 if occupancy[i] > 0 else 0
-                        i += 1
-        
-        occupancy = np.append(occupancy, second_layer)
-        
-        #print('Agent {}'.format(handle))
-        #print('Occupancy, first layer: {}'.format(occupancy))
-        #print('Occupancy, second layer: {}'.format(second_layer))
-         
         # Bifurcation points, one-hot encoded layer of predicted cells where 1 means that this cell is a fork 
         # (globally - considering cell transitions not depending on agent orientation) 
-        forks = np.zeros(self.max_prediction_depth, dtype=int)
-        # Target
-        target = np.zeros(self.max_prediction_depth, dtype=int)
-        for index in range(self.max_prediction_depth):
-            # Fill as 1 if transitions represent a fork cell
-            cell = self.cells_sequence[handle][index]
-            if cell in self.forks_coords:
-                forks[index] = 1
-            if cell == agent.target:
-                target[index] = 1
-        
-        # print('Forks: {}'.format(forks))
-        # print('Target: {}'.format(target))
-        
-        #  Speed/priority
-        is_conflict = True if len(conflicting_agents) > 0 else False
-        priority = assign_priority(self.env, agent, is_conflict)
-        max_prio_encountered = 0
-        if is_conflict:
-            conflicting_agents_priorities = [assign_priority(self.env, agents[ca], True) for ca in conflicting_agents]
-            max_prio_encountered = np.min(conflicting_agents_priorities)  # Max prio is the one with lowest value
-        
-        #print('Priority: {}'.format(priority))
-        #print('Max priority encountered: {}'.format(max_prio_encountered))
-        
-        # Malfunctioning obs
-        # Counting number of agents that are currently malfunctioning (globally) - experimental
-        n_agents_malfunctioning = 0  # in TreeObs they store the length of the longest malfunction encountered
-        for a in agents:
-            if a.malfunction_data['malfunction'] != 0:
-                n_agents_malfunctioning += 1  # Considering ALL agents
-                
-        #print('Num malfunctioning agents (globally): {}'.format(n_agents_malfunctioning))
+        # Target, 1 where the predicted cell is the agent target
+        is_predicted = self.predictions.is_predicted[handles]  # Agents DONE_REMOVED have no prediction
+        rows = self.predictions.rows[handles]
+        cols = self.predictions.cols[handles]
+        obs[:, depth * 2:depth * 3] = is_predicted & self.forks_mask[rows, cols]
+        targets = np.array([agents[a].target for a in handles])
+        obs[:, depth * 3:depth * 4] = is_predicted & (rows == targets[:, 0:1]) & (cols == targets[:, 1:2])
+
+        for i, handle in enumerate(handles):
+            # Occupancy
+            occupancy, conflicting_agents = self._fill_occupancy(handle)
+            obs[i, :depth] = occupancy
+            # Augment occupancy with another one-hot encoded layer: 1 if this cell is overlapping and the conflict span
+            # was already entered by some other agent - set to 1 the whole span (left and right side of the conflict)
+            for ca in conflicting_agents:
+                ca_position = agents[ca].position
+                if np.any((rows[i] == ca_position[0]) & (cols[i] == ca_position[1]) & is_predicted[i]):
+                    obs[i, depth:depth * 2] = occupancy > 0
+                    break
 
-        # Agents status (agents ready to depart) - it tells the agent how many will appear - encountered? or globally?
-        n_agents_ready_to_depart = 0
-        for a in agents:
-            if a.status in [RailAgentStatus.READY_TO_DEPART]:
-                n_agents_ready_to_depart += 1  # Considering ALL agents
-                
-        #print('Num agents ready to depart (globally): {}'.format(n_agents_ready_to_depart))
-        # shape (prediction_depth * 4 + 4, )
-        agent_obs = np.append(occupancy, forks)
-        agent_obs = np.append(agent_obs, target)
-        agent_obs = np.append(agent_obs, (priority, max_prio_encountered, n_agents_malfunctioning, n_agents_ready_to_depart))
+            #  Speed/priority
+            is_conflict = len(conflicting_agents) > 0
+            obs[i, depth * 4] = assign_priority(self.env, agents[handle], is_conflict)
+            if is_conflict:
+                # Max prio is the one with lowest value
+                obs[i, depth * 4 + 1] = np.min([assign_priority(self.env, agents[ca], True) for ca in conflicting_agents])
 
         # With this obs the agent actually decided only if it has to move or stop
-        return agent_obs
+        return obs
     
 
+    def _update_next_actions(self):
+        """
+        Look up the shortest path action of all active agents at once in the NextActionTable, used by
+        choose_railenv_action() until the next step.
+        :return:
+        """
+        agents = self.env.agents
+        self.next_actions = np.full(len(agents), -1, dtype=int)
+        active = np.array(sorted(self.agents_status.active), dtype=int)
+        if len(active) > 0:
+            positions = np.array([agents[a].position for a in active.tolist()], dtype=int)
+            directions = np.array([agents[a].direction for a in active.tolist()], dtype=int)
+            self.next_actions[active] = self.next_action_table.get_actions(active, positions, directions)
+
     # TODO Stop when shortest_path.py() says that rail is disrupted 
     def _get_shortest_path_action(self, handle):
         """
         Takes an agent handle and returns next action for that agent following shortest path:
         - if agent status == READY_TO_DEPART => agent moves forward;
-        - if agent status == ACTIVE => pick action using shortest_path.py() fun available in prediction utils;
+        - if agent status == ACTIVE => pick the action of the first step of the shortest path (see NextActionTable),
+        as computed in the last get_many();
         - if agent status == DONE => agent does nothing.
         :param handle: 
         :return: 
@@ -233,37 +286,14 @@ class GraphObsForRailEnv(ObservationBuilder):
                 action = RailEnvActions.DO_NOTHING
             
 
-        elif agent.status == RailAgentStatus.ACTIVE: # TODO Move k_shortest_paths from here - this is computationally expensive
-            # This can return None when rails are disconnected or there was an error in the DistanceMap
-            shortest_paths = self.predictor.get_shortest_paths()
-            '''
-            k_shortest_paths = self.predictor.get_k_shortest_paths(
-                source_position=agent.position, 
-                source_direction=agent.direction, 
-                target_position=agent.target, 
-                k=3,
-                debug=True)
-            '''
-            if shortest_paths[handle] is None:  # Railway disrupted
+        elif agent.status == RailAgentStatus.ACTIVE:
+            # Action of the first step of the shortest path, looked up in get_many() (see _update_next_actions())
+            next_action = self.next_actions[handle]
+            # -1 when rails are disconnected or there was an error in the DistanceMap
+            if next_action == -1:  # Railway disrupted
                 action = RailEnvActions.STOP_MOVING
             else:
-                step = shortest_paths[handle][0]
-                next_action_element = step[2][0]  # Get next_action_element
-                ''' THIS WORKS WITH NEXT VERSION
-                next_direction = shortest_paths[handle][1].direction
-                next_position = shortest_paths[handle][1].position # COULD return None?
-                action = get_action_for_move(agent.position, agent.direction, next_position, next_direction, self.env.rail)
-                
-                if action is None:
-                    action = RailEnvActions.DO_NOTHING
-                '''
-                # Just to use the correct form/name
-                if next_action_element == 1:
-                    action = RailEnvActions.MOVE_LEFT
-                elif next_action_element == 2:
-                    action = RailEnvActions.MOVE_FORWARD
-                elif next_action_element == 3:
-                    action = RailEnvActions.MOVE_RIGHT
+                action = RailEnvActions(next_action)
                 
         else:  # If status == DONE
             action = RailEnvActions.DO_NOTHING
@@ -449,42 +479,28 @@ class GraphObsForRailEnv(ObservationBuilder):
         :return occupancy_counter, conflicting_agents
         """
         occupancy_counter = 0
-        cell_pos = self.predicted_pos_coord[ts][handle]
-        int_pos = self.predicted_pos[ts][handle]
+        cell_pos = self.predictions.cells[handle, ts]
+        int_pos = int(self.predictions.positions[handle, ts])
         pre_ts = max(0, ts - 1)
         post_ts = min(self.max_prediction_depth - 1, ts + 1)
-        int_direction = int(self.predicted_dir[ts][handle])
-        cell_transitions = self.env.rail.get_transitions(int(cell_pos[0]), int(cell_pos[1]), int_direction)
+        directions = self.predictions.directions
+        cell_transitions = self.rail_cache.transitions[cell_pos[0], cell_pos[1], directions[handle, ts]]
         conflicting_agents_ts = set()
-    
-        # Careful, int_pos, predicted_pos are not (y, x) but are given as int
-        if int_pos in np.delete(self.predicted_pos[ts], handle, 0):
-            conflicting_agents = np.where(self.predicted_pos[ts] == int_pos)
-            for ca in conflicting_agents[0]:
-                if self.env.agents[ca].status == RailAgentStatus.ACTIVE:
-                    if self.predicted_dir[ts][handle] != self.predicted_dir[ts][ca] and cell_transitions[self._reverse_dir(self.predicted_dir[ts][ca])] == 1:
-                        if not (self._is_following(ca, handle)):
-                            occupancy_counter += 1
-                            conflicting_agents_ts.add(ca)
-                    
-        elif int_pos in np.delete(self.predicted_pos[pre_ts], handle, 0):
-            conflicting_agents = np.where(self.predicted_pos[pre_ts] == int_pos)
-            for ca in conflicting_agents[0]:
-                if self.env.agents[ca].status == RailAgentStatus.ACTIVE:
-                    if self.predicted_dir[ts][handle] != self.predicted_dir[pre_ts][ca] and cell_transitions[self._reverse_dir(self.predicted_dir[pre_ts][ca])] == 1:
-                        if not (self._is_following(ca, handle)):
-                            occupancy_counter += 1
-                            conflicting_agents_ts.add(ca)
-                            
-        elif int_pos in np.delete(self.predicted_pos[post_ts], handle, 0):
-            conflicting_agents = np.where(self.predicted_pos[post_ts] == int_pos)
-            for ca in conflicting_agents[0]:
-                if self.env.agents[ca].status == RailAgentStatus.ACTIVE:
-                    if self.predicted_dir[ts][handle] != self.predicted_dir[post_ts][ca] and cell_transitions[self._reverse_dir(self.predicted_dir[post_ts][ca])] == 1:
+
+        # Careful, int_pos, predicted positions are not (y, x) but are given as int
+        # Check current ts first, then pre ts and post ts, only the first one where other agents are predicted counts
+        for other_ts in (ts, pre_ts, post_ts):
+            agents_in_cell = self.reservations.get_holders(int_pos, other_ts)
+            if not any(ca != handle for ca in agents_in_cell):
+                continue
+            for ca in agents_in_cell:
+                if ca in self.agents_status.active:
+                    if directions[handle, ts] != directions[ca, other_ts] and cell_transitions[self._reverse_dir(directions[ca, other_ts])] == 1:
                         if not (self._is_following(ca, handle)):
                             occupancy_counter += 1
                             conflicting_agents_ts.add(ca)
-                            
+            break
+
         return occupancy_counter, conflicting_agents_ts
 
 
@@ -498,7 +514,6 @@ class GraphObsForRailEnv(ObservationBuilder):
         """
         occupancy = np.zeros(self.max_prediction_depth, dtype=int)
         conflicting_agents = set()
-        overlapping_paths = self._compute_overlapping_paths(handle)
         # cells_sequence = self.cells_sequence[handle]
         # span_cells = []
         
@@ -511,11 +526,10 @@ class GraphObsForRailEnv(ObservationBuilder):
         # But only with THAT agent
         # Because I could have overlapping paths but without conflict (TODO improve)
         if len(conflicting_agents) != 0: # If there was conflict
-            for ca in conflicting_agents:
-                for ts in range(self.max_prediction_depth):
-                    occupancy[ts] = overlapping_paths[ca, ts] if occupancy[ts] == 0 else 1
-                    # if occupancy[ts]:
-                    #    span_cells.append(cells_sequence[ts]) # Save occupancy as sequence of cells too
+            overlapping_paths = self._compute_overlapping_paths(handle)
+            # 1 where there was a possible conflict or the path overlaps with the path of any conflicting agent
+            overlapping_with_conflicting = overlapping_paths[list(conflicting_agents)].any(axis=0)
+            occupancy = ((occupancy > 0) | overlapping_with_conflicting).astype(int)
         '''               
         if not self.overlapping_spans[handle]: # If empty means it's the first time or there weren't overlapping paths
             self.overlapping_spans.update({handle: span_cells})
@@ -551,16 +565,9 @@ class GraphObsForRailEnv(ObservationBuilder):
         :return: overlapping_paths is a np.array that computes path overlapping for pairs of agents, where 1 means overlapping.
         Each layer represents overlapping with one particular agent.
         """
-        overlapping_paths = np.zeros((self.env.get_num_agents(), self.max_prediction_depth), dtype=int)
-        cells_sequence = self.predicted_pos_list[handle]
-        for a in range(len(self.env.agents)):
-            if a != handle:
-                i = 0
-                other_agent_cells_sequence = self.predicted_pos_list[a]
-                for pos in cells_sequence:
-                    if pos in other_agent_cells_sequence:
-                        overlapping_paths[a, i] = 1
-                    i += 1
+        # Read the cells of this agent path in the boolean matrix of cells visited by each agent (computed once per step)
+        overlapping_paths = self.visited_cells[:, self.predicted_cell_ids[handle]].astype(int)
+        overlapping_paths[handle] = 0
         return overlapping_paths
         
         
@@ -572,7 +579,7 @@ class GraphObsForRailEnv(ObservationBuilder):
         """
         agent = self.env.agents[handle]
         overlapping_paths = np.zeros((self.env.get_num_agents(), self.max_prediction_depth + 1), dtype=int)
-        cells_sequence = self.predicted_pos_list[handle]
+        cells_sequence = self.predictions.positions[handle]
         # Prepend current ts
         if agent.status == RailAgentStatus.ACTIVE: 
             virtual_position = agent.position
@@ -584,7 +591,7 @@ class GraphObsForRailEnv(ObservationBuilder):
             if a != handle and self.env.agents[a].status == RailAgentStatus.ACTIVE:
                 i = 0
                 # Prepend other agents current ts
-                other_agent_cells_sequence = self.predicted_pos_list[a]
+                other_agent_cells_sequence = self.predictions.positions[a]
                 other_int_pos = coordinate_to_position(self.env.width, [self.env.agents[a].position])
                 other_agent_cells_sequence = np.append(other_int_pos[0], other_agent_cells_sequence)
                 for pos in cells_sequence:
@@ -596,33 +603,10 @@ class GraphObsForRailEnv(ObservationBuilder):
     def _find_forks(self):
         """
         A fork (in the map) is either a switch or a diamond crossing.
-        :return: 
+        :return: np.array of shape (env.height, env.width), True if the cell is a fork
         """
-        forks = set() # Set of nodes as tuples/coordinates
-        # Identify cells hat are nodes (have switches)
-        for i in range(self.env.height):
-            for j in range(self.env.width):
-
-                is_switch = False
-                is_crossing = False
-
-                # Check if diamond crossing
-                transitions_bit = bin(self.env.rail.get_full_transitions(i, j))
-                if int(transitions_bit, 2) == int('1000010000100001', 2):
-                    is_crossing = True
-
-                else:
-                    # Check if switch
-                    for direction in (0, 1, 2, 3):  # 0:N, 1:E, 2:S, 3:W
-                        possible_transitions = self.env.rail.get_transitions(i, j, direction)
-                        num_transitions = np.count_nonzero(possible_transitions)
-                        if num_transitions > 1:
-                            is_switch = True
-
-                if is_switch or is_crossing:
-                    forks.add((i, j))
-        
-        return forks
+        # Identify cells that are nodes (have switches) or diamond crossings
+        return self.rail_cache.switch_mask | self.rail_cache.crossing_mask
     
     def _is_following(self, handle1, handle2):
         """
@@ -15,8 +15,9 @@ from flatland.core.grid.grid4_utils import get_new_position
 from flatland.core.grid.grid_utils import coordinate_to_position
 from flatland.envs.agent_utils import RailAgentStatus, EnvAgent
 from flatland.utils.ordered_set import OrderedSet
-from flatland.envs.distance_map import DistanceMap
-from flatland.envs.rail_env_shortest_paths import get_shortest_paths
+
+from src.distance_maps import walk_shortest_paths
+from src.rail_cache import get_rail_cache
 
 
 class LocalObsForRailEnv(ObservationBuilder):
@@ -45,17 +46,39 @@ class LocalObsForRailEnv(ObservationBuilder):
     The offset parameter moves the agent along the height axis of this rectangle, 0 <= offset <= view_height.
     If equal to view_height the agent only has observation in front of it, if equal to 0 the agent has only observation 
     behind.
+
+    With batched=True the three elements are concatenated and written by get_many() into a single float32 buffer of
+    shape (num_agents, 16 + 5 + 2, 2 * view_semiwidth + 1, view_height), the same of preprocess_obs() applied to each
+    observation, so that it can be fed as is to the ConvQNetwork: the observation of each agent is a view of the
+    buffer, that is reused (overwritten) at each step.
     """
-    def __init__(self, view_semiwidth, view_height, offset):
+    def __init__(self, view_semiwidth, view_height, offset, map_artifacts=None, batched=False):
 
         super(LocalObsForRailEnv, self).__init__()
         self.view_semiwidth = view_semiwidth
         self.view_width = 2 * self.view_semiwidth + 1
         self.view_height = view_height
         self.offset = offset  # Agent offset along axis of the agent's direction
+        self.map_artifacts = map_artifacts  # MapArtifacts loaded at reset(), if None structures are computed
+        self.batched = batched
+        # Batched observations of all agents, np.array of shape (num_agents, 23, view_width, view_height)
+        self.observations = None
+        # np.array of shape (4, view_height, view_width, 2), offset (rows, columns) of each cell of the field of view
+        # from the agent position, for each direction of the agent
+        self.view_offsets = self._get_view_offsets()
         self.rail_obs = None
         self.targets_obs = None
-        self.shortest_paths = None
+        # Layers of the whole env, filled once per step by get_many() and cropped by get(): np.array of shape
+        # (env.height, env.width, 4) with direction, malfunction and speed of active agents and initial direction of
+        # agents ready to depart, np.array of shape (env.height, env.width), 1 on the targets of the agents
+        self.agents_layers = None
+        self.targets_layer = None
+        # Shortest path of each agent, as returned by walk_shortest_paths(): waypoints walked, number of moves and
+        # False for agents without path
+        self.paths = None
+        self.path_lengths = None
+        self.has_path = None
+        self.is_removed = None  # np.array of shape (num_agents,), True for agents DONE_REMOVED (without observation)
 
     def set_env(self, env: Environment):
         super().set_env(env)
@@ -63,16 +86,13 @@ class LocalObsForRailEnv(ObservationBuilder):
     def reset(self):
         # Useful for precomputing stuff - at the beginning of an episode
         # Precompute rail_obs of ALL env - then compute local rail obs from this
-        self.rail_obs = np.zeros((self.env.height, self.env.width, 16))  # Transition map of the whole env
-        for i in range(self.env.height):
-            for j in range(self.env.width):
-                bitlist = [int(digit) for digit in bin(self.env.rail.get_full_transitions(i, j))[2:]]
-                bitlist = [0] * (16 - len(bitlist)) + bitlist
-                self.rail_obs[i, j] = np.array(bitlist)
+        # Transition map of the whole env, 16 bits encoding of transitions (uint8 bit planes, shared by the rail cache)
+        if self.map_artifacts is not None:
+            self.map_artifacts.load(self.env.rail, self.env.agents)
+        self.rail_obs = get_rail_cache(self.env.rail).rail_planes
         # Global targets - not subtargets
         self.targets_obs = np.zeros((self.view_height, self.view_width, 2))
-        distance_map: DistanceMap = self.env.distance_map
-        self.shortest_paths = get_shortest_paths(distance_map)  # TODO Must be computed in the get_many since at reset it doesn't fill values. but i don't want to compute it everytime
+        self._walk_shortest_paths()
 
 
     def get(self, handle: int = 0) -> (np.ndarray, np.ndarray, np.ndarray):
@@ -93,43 +113,26 @@ class LocalObsForRailEnv(ObservationBuilder):
             return None
             
         # Compute field of view
-        visible_cells, rel_coords = self._field_of_view(agent_virtual_position, agent.direction)
-        subtarget = self._find_subtarget(handle, visible_cells)
+        cells, is_visible = self._field_of_view(agent_virtual_position, agent.direction)
+        subtargets, has_subtarget = self._find_subtargets(np.array([handle]), is_visible[np.newaxis])
         # Add the visited cells to the observed cells (for visualization)
-        self.env.dev_obs_dict[handle] = set(visible_cells)
+        self.env.dev_obs_dict[handle] = set(tuple(cell) for cell in cells[is_visible].tolist())
         
-        # Get local rail_obs
-        local_rail_obs = np.zeros((self.view_height, self.view_width, 16))
-        # Build agents obs
+        # Get local rail_obs, as a crop of the rail of the whole env
+        local_rail_obs = self.rail_obs[cells[:, :, 0], cells[:, :, 1]] * is_visible[:, :, np.newaxis].astype(float)
+        # Build agents obs: other agents from the layers of the whole env
         agents_state_obs = np.zeros((self.view_height, self.view_width, 5))
+        agents_state_obs[:, :, 1:] = self.agents_layers[cells[:, :, 0], cells[:, :, 1]] * is_visible[:, :, np.newaxis]
+        # Collect this agent position and direction, the agent is always in (offset, view_semiwidth) of its view
+        if self.offset < self.view_height:
+            agents_state_obs[self.offset, self.view_semiwidth, 0] = agent.direction
         # Build targets obs
         targets_obs = np.zeros((self.view_height, self.view_width, 2))
-        i = 0
-        for pos in visible_cells:  # Absolute coords
-            curr_rel_coord = rel_coords[i]  # Convert into relative coords
-            local_rail_obs[curr_rel_coord[0], curr_rel_coord[1], :] = self.rail_obs[pos[0], pos[1], :]
-            
-            if pos == agent_virtual_position:
-                # Collect this agent position and direction
-                agents_state_obs[curr_rel_coord[0], curr_rel_coord[1], 0] = agent.direction
-            if pos == subtarget:
-                # Collect position of agent target
-                targets_obs[curr_rel_coord[0], curr_rel_coord[1], 0] = 1     
-            for a in agents:
-                # Collect info about active agents: positions and directions, malfunctions length, speed/priorities
-                if a.status == RailAgentStatus.ACTIVE:
-                    if pos == a.position:
-                        agents_state_obs[curr_rel_coord[0], curr_rel_coord[1], 1] = a.direction
-                        agents_state_obs[curr_rel_coord[0], curr_rel_coord[1], 2] = a.malfunction_data['malfunction']
-                        agents_state_obs[curr_rel_coord[0], curr_rel_coord[1], 3] = a.speed_data['speed']
-                # Collect info about ready to depart agents
-                elif a.status == RailAgentStatus.READY_TO_DEPART:
-                    if pos == a.initial_position:
-                        agents_state_obs[curr_rel_coord[0], curr_rel_coord[1], 4] = a.initial_direction
-                # Collect positions of other agents targets
-                if pos == a.target:
-                    targets_obs[curr_rel_coord[0], curr_rel_coord[1], 1] = 1
-            i += 1
+        if has_subtarget[0]:
+            # Collect position of agent target
+            targets_obs[subtargets[0, 0], subtargets[0, 1], 0] = 1
+        # Collect positions of other agents targets
+        targets_obs[:, :, 1] = self.targets_layer[cells[:, :, 0], cells[:, :, 1]] * is_visible
             
         return local_rail_obs, agents_state_obs, targets_obs
     
@@ -138,68 +141,161 @@ class LocalObsForRailEnv(ObservationBuilder):
         Called whenever an observation has to be computed for the `env` environment, for each agent with handle
         in the `handles` list.
         """
-        self.shortest_paths = get_shortest_paths(self.env.distance_map)
+        self._walk_shortest_paths()
+        self._scatter_agents_layers()
+        if self.batched:
+            return self._get_many_batched(handles)
         return super().get_many(handles)
+
+    def _get_many_batched(self, handles):
+        """
+        Write the observations of the agents in handles into self.observations, as preprocess_obs() of the
+        observations returned by get(), computing the fields of view of all agents at once.
+        :param handles: list of handles, None for no agent (as in ObservationBuilder.get_many())
+        :return: dict handle : view of self.observations (None if agent has status DONE_REMOVED)
+        """
+        num_agents = len(self.env.agents)
+        shape = (num_agents, 16 + 5 + 2, self.view_width, self.view_height)
+        if self.observations is None or self.observations.shape != shape:
+            self.observations = np.zeros(shape, dtype=np.float32)
+        requested_handles = list(handles) if handles is not None else []
+        handles = np.array(requested_handles, dtype=int)
+        self.observations[handles[self.is_removed[handles]]] = 0
+        handles = handles[~self.is_removed[handles]]
+
+        # Fields of view of all agents, with axes swapped as in preprocess_obs()
+        waypoints = self.paths[handles, 0]
+        cells = self.view_offsets[waypoints[:, 2]] + waypoints[:, np.newaxis, np.newaxis, 0:2]
+        is_visible = (cells[..., 0] >= 0) & (cells[..., 0] < self.env.height) & \
+                     (cells[..., 1] >= 0) & (cells[..., 1] < self.env.width)
+        subtargets, has_subtarget = self._find_subtargets(handles, is_visible)
+        cells = np.swapaxes(cells, 1, 2)
+        is_visible = np.swapaxes(is_visible, 1, 2)
+        rows = np.clip(cells[..., 0], 0, self.env.height - 1)
+        cols = np.clip(cells[..., 1], 0, self.env.width - 1)
+
+        # Rail, agents and targets channels, each cropped from the layer of the whole env
+        self.observations[handles, 0:16] = np.moveaxis(self.rail_obs[rows, cols] * is_visible[..., np.newaxis], 3, 1)
+        self.observations[handles, 16] = 0
+        if self.offset < self.view_height:
+            self.observations[handles, 16, self.view_semiwidth, self.offset] = waypoints[:, 2]
+        self.observations[handles, 17:21] = np.moveaxis(self.agents_layers[rows, cols] * is_visible[..., np.newaxis],
+                                                        3, 1)
+        self.observations[handles, 22] = self.targets_layer[rows, cols] * is_visible
+
+        self.observations[handles, 21] = 0
+        self.observations[handles[has_subtarget], 21, subtargets[has_subtarget, 1], subtargets[has_subtarget, 0]] = 1
+
+        # Add the visited cells to the observed cells (for visualization)
+        for i, handle in enumerate(handles.tolist()):
+            self.env.dev_obs_dict[handle] = set(
+                tuple(cell) for cell in np.stack((rows[i], cols[i]), axis=2)[is_visible[i]].tolist())
+
+        return {handle: None if self.is_removed[handle] else self.observations[handle] for handle in requested_handles}
+
+    def _scatter_agents_layers(self):
+        """
+        Fill the layers of the whole env with the state of all agents, from which the local observation of each agent
+        is cropped.
+        :return:
+        """
+        agents = self.env.agents
+        self.agents_layers = np.zeros((self.env.height, self.env.width, 4))
+        self.targets_layer = np.zeros((self.env.height, self.env.width))
+        active_agents = [a for a in agents if a.status == RailAgentStatus.ACTIVE]
+        if active_agents:
+            rows, cols = np.array([a.position for a in active_agents]).T
+            self.agents_layers[rows, cols, 0] = [a.direction for a in active_agents]
+            self.agents_layers[rows, cols, 1] = [a.malfunction_data['malfunction'] for a in active_agents]
+            self.agents_layers[rows, cols, 2] = [a.speed_data['speed'] for a in active_agents]
+        ready_agents = [a for a in agents if a.status == RailAgentStatus.READY_TO_DEPART]
+        if ready_agents:
+            rows, cols = np.array([a.initial_position for a in ready_agents]).T
+            self.agents_layers[rows, cols, 3] = [a.initial_direction for a in ready_agents]
+        if agents:
+            rows, cols = np.array([a.target for a in agents]).T
+            self.targets_layer[rows, cols] = 1
+
+    def _walk_shortest_paths(self):
+        """
+        Walk the shortest paths of all agents at once, from their current (or initial) position to their target.
+        :return:
+        """
+        agents = self.env.agents
+        waypoints = np.zeros((len(agents), 3), dtype=int)
+        is_removed = np.zeros(len(agents), dtype=bool)
+        for agent in agents:
+            if agent.status == RailAgentStatus.READY_TO_DEPART:
+                agent_virtual_position = agent.initial_position
+            elif agent.status == RailAgentStatus.ACTIVE:
+                agent_virtual_position = agent.position
+            elif agent.status == RailAgentStatus.DONE:
+                agent_virtual_position = agent.target
+            else:  # agent is DONE_REMOVED
+                is_removed[agent.handle] = True
+                continue
+            waypoints[agent.handle] = (*agent_virtual_position, agent.direction)
+        self.paths, self.path_lengths, self.has_path = walk_shortest_paths(self.env.rail, agents, waypoints, is_removed)
+        self.is_removed = is_removed
     
 
+    def _get_view_offsets(self):
+        """
+        The field of view of the agent facing north has its origin (the upper-left corner) offset rows above and
+        view_semiwidth columns on the left of the agent, for the other directions the rectangle is rotated around the
+        agent (e.g. by 90° clockwise facing east).
+        :return: np.array of shape (4, view_height, view_width, 2), offset (rows, columns) of each cell (i, j) of the
+        field of view from the agent position, for each direction
+        """
+        i, j = np.meshgrid(np.arange(self.view_height), np.arange(self.view_width), indexing='ij')
+        rows = i - self.offset
+        cols = j - self.view_semiwidth
+        return np.stack((np.stack((rows, cols), axis=2),  # North
+                         np.stack((cols, -rows), axis=2),  # East
+                         np.stack((-rows, -cols), axis=2),  # South
+                         np.stack((-cols, rows), axis=2)))  # West
+
     def _field_of_view(self, position, direction):
         """
         :param position: current agent position as tuple (y, x)
         :param direction: current agent direction in [0, 3]
-        :return: Field of view of the agent as np.array of cells on the grid in absolute coordinates. 
-        Value is -np.inf to indicate padding (when agent lies on border).
-        """
-        # Compute visible cells
-        # visible_cells = np.full((self.view_height, self.view_width, 2), -np.inf, dtype=int)
-        visible_cells = list()
-        rel_coords = list()
-
-        if direction == 0:  # North
-            origin = (position[0] - self.offset, position[1] - self.view_semiwidth)
-        elif direction == 1:  # East
-            origin = (position[0] - self.view_semiwidth, position[1] + self.offset)
-        elif direction == 2:  # South
-            origin = (position[0] + self.offset, position[1] + self.view_semiwidth)
-        else:  # West
-            origin = (position[0] + self.view_semiwidth, position[1] - self.offset)
-
-        for i in range(self.view_height):
-            for j in range(self.view_width):
-                if direction == 0:
-                    cell_to_add = (origin[0] + i, origin[1] + j)
-                elif direction == 1:  # Rectangle is flipped 90°
-                    cell_to_add = (origin[0] + j, origin[1] - i)
-                elif direction == 2:
-                    cell_to_add = (origin[0] - i, origin[1] - j)
-                elif direction == 3:
-                    cell_to_add = (origin[0] - j, origin[1] + i)
-
-                if cell_to_add[0] >= self.env.height or cell_to_add[1] >= self.env.width or cell_to_add[0] < 0 or \
-                        cell_to_add[1] < 0:
-                    break
-                # visible_cells[i, j] = cell_to_add  # In absolute coordinates
-                visible_cells.append(cell_to_add)
-                rel_coords.append((i, j))
-                
-        return visible_cells, rel_coords
+        :return: Field of view of the agent as np.array of shape (view_height, view_width, 2) of cells on the grid in
+        absolute coordinates, clipped to the grid, and np.array of shape (view_height, view_width), True if the cell is
+        inside the grid (False for padding, when agent lies on border).
+        """
+        cells = self.view_offsets[direction] + position
+        is_visible = (cells[:, :, 0] >= 0) & (cells[:, :, 0] < self.env.height) & \
+                     (cells[:, :, 1] >= 0) & (cells[:, :, 1] < self.env.width)
+        np.clip(cells[:, :, 0], 0, self.env.height - 1, out=cells[:, :, 0])
+        np.clip(cells[:, :, 1], 0, self.env.width - 1, out=cells[:, :, 1])
+        return cells, is_visible
 
-    
-    def _find_subtarget(self, handle, visible_cells):
-        """
-        :param handle: agent id, 
-        :param visible_cells: pos (y, x) of visible cells for agent in absolute coordinates
-        :return: cell in the shortest path of this agent (handle) that is closest to target and visible to the agent 
-        (i.e. in its field of view). Equal to real target when already visible.
-        None if shortest_path for this agent couldn't be computed (e.g. rail was disconnected).
-        """
-        if self.shortest_paths:
-            # Get shortest path
-            shortest_path = self.shortest_paths[handle]
-            # Walk path from target to source to find first pos that is in view
-            if shortest_path:
-                for i in range(len(shortest_path) - 1, -1, -1):
-                    cell = shortest_path[i][0]
-                    if cell in visible_cells: # Not really efficient
-                        return cell
-        
-        return None
\ No newline at end of file
+    def _find_subtargets(self, handles, is_visible):
+        """
+        Cells of the shortest path of each agent are mapped to the field of view of the agent (rotating their offset
+        from the agent position as in _get_view_offsets(), backwards) and matched against its visibility mask, the
+        subtarget is the visible cell with the highest index in the path.
+        :param handles: np.array of shape (num_handles,), agents ids
+        :param is_visible: np.array of shape (num_handles, view_height, view_width), visibility mask of the field of
+        view of each agent, as returned by _field_of_view()
+        :return: np.array of shape (num_handles, 2), coordinates (i, j) in the field of view of the cell in the shortest
+        path of each agent that is closest to target and visible to the agent. Equal to real target when already
+        visible. np.array of shape (num_handles,), False if shortest_path for this agent couldn't be computed (e.g. rail
+        was disconnected) or none of its cells is visible.
+        """
+        paths = self.paths[handles]
+        offsets = paths[:, :, 0:2] - paths[:, 0:1, 0:2]
+        # Rotation from offsets (rows, columns) to the axes (i, j) of the field of view, for each direction
+        rotations = np.array([[[1, 0], [0, 1]], [[0, -1], [1, 0]], [[-1, 0], [0, -1]], [[0, 1], [-1, 0]]])
+        view_coords = np.einsum('nij,nkj->nki', rotations[paths[:, 0, 2]], offsets) + (self.offset, self.view_semiwidth)
+        is_in_view = (view_coords[:, :, 0] >= 0) & (view_coords[:, :, 0] < self.view_height) & \
+                     (view_coords[:, :, 1] >= 0) & (view_coords[:, :, 1] < self.view_width)
+        is_in_view &= is_visible[np.arange(len(handles))[:, np.newaxis],
+                                 np.clip(view_coords[:, :, 0], 0, self.view_height - 1),
+                                 np.clip(view_coords[:, :, 1], 0, self.view_width - 1)]
+        is_in_view &= np.arange(paths.shape[1]) <= self.path_lengths[handles, np.newaxis]
+        # Walk path from target to source to find first pos that is in view
+        subtarget_indices = np.max(np.where(is_in_view, np.arange(paths.shape[1]), -1), axis=1, initial=-1)
+        has_subtarget = self.has_path[handles] & (subtarget_indices >= 0)
+        subtargets = view_coords[np.arange(len(handles)), np.maximum(subtarget_indices, 0)]
+        return subtargets, has_subtarget
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""
+On-disk artifacts of the structures derived from a map (rail cache, switch graph, distance maps of the targets and next
+action table), precomputed once for fixed maps (e.g. the levels in test-envs/) by src/build_map_artifacts.py and loaded
+by observation builders at reset(), instead of being recomputed at each episode.
+Each map has its own directory, named by the hash of its content (rail and targets of the agents), with one .npy file
+per array, loaded as read-only memory-mapped arrays: only the pages actually used are read from disk.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+from src.distance_maps import get_next_action_table, get_target_distance_maps, NextActionTable, TargetDistanceMaps, \
+    _next_action_tables, _target_distance_maps
+from src.rail_cache import get_rail_cache, RailCache, _rail_caches
+from src.switch_graph import get_switch_graph, SwitchGraph, _switch_graphs
+
+# Arrays of each structure stored in the artifact, file names are <structure>.<attribute>.npy
+RAIL_CACHE_ARRAYS = ('rail_planes', 'rail_mask', 'dead_end_mask', 'switch_mask', 'crossing_mask', 'move_exits',
+                     'move_mask', 'move_waypoints')
+SWITCH_GRAPH_ARRAYS = ('node_cells', 'node_ids', 'indptr', 'edge_sources', 'edge_targets', 'edge_exit_directions',
+                       'edge_entry_directions', 'edge_lengths', 'cells_indptr', 'cells', 'waypoint_edges',
+                       'waypoint_offsets')
+DISTANCE_MAPS_ARRAYS = ('targets', 'agent_targets', 'flat_distances')
+NEXT_ACTION_TABLE_ARRAYS = ('actions', 'next_directions')
+
+
+def get_map_hash(rail, agents):
+    """
+    :param rail: GridTransitionMap of the env
+    :param agents: env.agents
+    :return: hex digest of the content of the map, i.e. the grid and the targets of the agents
+    """
+    grid = np.ascontiguousarray(rail.grid, dtype=np.uint16)
+    targets = np.array([agent.target for agent in agents], dtype=np.int64).reshape((-1, 2))
+    map_hash = hashlib.sha1()
+    map_hash.update(np.array(grid.shape, dtype=np.int64).tobytes())
+    map_hash.update(grid.tobytes())
+    map_hash.update(targets.tobytes())
+    return map_hash.hexdigest()
+
+
+def _compact(array):
+    """
+    :param array: np.array
+    :return: the array with 64 bits floats and integers converted to 32 bits, when they hold its values
+    """
+    if array.dtype == np.float64:
+        return array.astype(np.float32)
+    if array.dtype.kind in 'iu' and array.dtype.itemsize > 4 and \
+            (array.size == 0 or (array.min() >= np.iinfo(np.int32).min and array.max() <= np.iinfo(np.int32).max)):
+        return array.astype(np.int32)
+    return array
+
+
+def _restore(cls, attributes):
+    """
+    Build an object of class cls from its attributes, without computing them again in __init__().
+    :param cls: class of the object
+    :param attributes: dict name : value
+    :return: the object
+    """
+    restored = cls.__new__(cls)
+    restored.__dict__.update(attributes)
+    return restored
+
+
+class MapArtifact:
+    """
+    Artifact of a single map, arrays are loaded (memory-mapped) when first accessed.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory of the artifact
+        """
+        self.path = Path(path)
+        self.arrays = {}
+
+    def __contains__(self, name):
+        return name in self.arrays or (self.path / (name + '.npy')).is_file()
+
+    def get(self, name):
+        """
+        :param name: name of the array
+        :return: read-only np.memmap
+        """
+        array = self.arrays.get(name)
+        if array is None:
+            array = np.load(str(self.path / (name + '.npy')), mmap_mode='r')
+            self.arrays[name] = array
+        return array
+
+
+class MapArtifacts:
+    """
+    Directory of MapArtifact, one for each map.
+
+    - directory: root directory of the artifacts
+    - num_loaded: number of maps loaded from disk
+    - num_missing: number of maps without artifact, whose structures are computed as usual
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: root directory of the artifacts, it doesn't need to exist unless artifacts are saved
+        """
+        self.directory = Path(directory)
+        self.num_loaded = 0
+        self.num_missing = 0
+        # Grid, targets and artifact last loaded for each rail, so that builders of the same env load it only once
+        self.loaded = weakref.WeakKeyDictionary()
+
+    def get_path(self, rail, agents):
+        """
+        :param rail: GridTransitionMap of the env
+        :param agents: env.agents
+        :return: directory of the artifact of the map
+        """
+        return self.directory / get_map_hash(rail, agents)
+
+    def save(self, rail, agents, extra_arrays=None):
+        """
+        Compute the structures derived from the map and write its artifact, replacing the previous one (if any).
+        :param rail: GridTransitionMap of the env
+        :param agents: env.agents
+        :param extra_arrays: dict name : np.array of other arrays to store as they are, e.g. observations of the rail
+        :return: directory of the artifact
+        """
+        rail_cache = get_rail_cache(rail)
+        switch_graph = get_switch_graph(rail, [agent.target for agent in agents])
+        target_distance_maps = get_target_distance_maps(rail, agents)
+        next_action_table = get_next_action_table(rail, agents)
+
+        arrays = {}
+        for prefix, structure, names in (('rail_cache', rail_cache, RAIL_CACHE_ARRAYS),
+                                         ('switch_graph', switch_graph, SWITCH_GRAPH_ARRAYS),
+                                         ('distance_maps', target_distance_maps, DISTANCE_MAPS_ARRAYS),
+                                         ('next_action_table', next_action_table, NEXT_ACTION_TABLE_ARRAYS)):
+            for name in names:
+                arrays[prefix + '.' + name] = _compact(getattr(structure, name))
+        arrays.update(extra_arrays or {})
+
+        # Arrays are written to a temporary directory, then moved, so that a partial artifact is never loaded
+        path = self.get_path(rail, agents)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temporary_path = tempfile.mkdtemp(dir=str(self.directory))
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary_path, name + '.npy'), np.asarray(array))
+        if path.exists():
+            shutil.rmtree(str(path))
+        os.rename(temporary_path, str(path))
+        return path
+
+    def load(self, rail, agents):
+        """
+        Load the artifact of the map (if any) and make its structures the ones returned by get_rail_cache(),
+        get_switch_graph(), get_target_distance_maps() and get_next_action_table() for this rail and agents.
+        :param rail: GridTransitionMap of the env
+        :param agents: env.agents
+        :return: MapArtifact, None if the map has no artifact
+        """
+        agents_targets = tuple(tuple(agent.target) for agent in agents)
+        loaded = self.loaded.get(rail)
+        if loaded is not None and loaded[0] is rail.grid and loaded[1] == agents_targets:
+            return loaded[2]
+
+        path = self.get_path(rail, agents)
+        if not path.is_dir():
+            self.num_missing += 1
+            self.loaded[rail] = (rail.grid, agents_targets, None)
+            return None
+        artifact = MapArtifact(path)
+
+        def get_arrays(prefix, names):
+            return {name: artifact.get(prefix + '.' + name) for name in names}
+
+        height, width = rail.grid.shape
+        rail_cache_arrays = get_arrays('rail_cache', RAIL_CACHE_ARRAYS)
+        transitions = rail_cache_arrays['rail_planes'].reshape((height, width, 4, 4))
+        rail_cache = _restore(RailCache, dict(rail_cache_arrays, grid=rail.grid, height=height, width=width,
+                                              transitions=transitions))
+        _rail_caches[rail] = rail_cache
+
+        switch_graph = _restore(SwitchGraph, dict(get_arrays('switch_graph', SWITCH_GRAPH_ARRAYS),
+                                                  grid=rail.grid, height=height, width=width,
+                                                  transitions=rail_cache.transitions,
+                                                  targets=frozenset(agents_targets)))
+        _switch_graphs[rail] = switch_graph
+
+        distance_maps_arrays = get_arrays('distance_maps', DISTANCE_MAPS_ARRAYS)
+        target_distance_maps = _restore(TargetDistanceMaps, dict(
+            distance_maps_arrays, grid=rail.grid, agents_targets=agents_targets,
+            distances=distance_maps_arrays['flat_distances'][:, :-1].reshape(
+                (len(distance_maps_arrays['targets']), height, width, 4))))
+        _target_distance_maps[rail] = target_distance_maps
+
+        next_action_table = _restore(NextActionTable, dict(get_arrays('next_action_table', NEXT_ACTION_TABLE_ARRAYS),
+                                                           targets=target_distance_maps.targets,
+                                                           agent_targets=target_distance_maps.agent_targets))
+        _next_action_tables[target_distance_maps] = next_action_table
+
+        self.num_loaded += 1
+        self.loaded[rail] = (rail.grid, agents_targets, artifact)
+        return artifact
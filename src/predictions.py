@@ -2,6 +2,8 @@
 Collection of environment-specific PredictionBuilder.
 """
 
+import hashlib
+import heapq
 import numpy as np
 from collections import defaultdict
 from typing import NamedTuple, Tuple, List
@@ -10,11 +12,14 @@ from typing import NamedTuple, Tuple, List
 from flatland.core.env_prediction_builder import PredictionBuilder
 from flatland.envs.agent_utils import RailAgentStatus
 from flatland.envs.rail_env import RailEnv
-from flatland.envs.distance_map import DistanceMap
 from flatland.envs.rail_env import RailEnvActions, RailEnvNextAction
 from flatland.envs.rail_env_shortest_paths import get_shortest_paths, get_new_position
 from flatland.utils.ordered_set import OrderedSet
 
+from src.distance_maps import get_target_distance_maps, walk_shortest_paths
+from src.rail_cache import get_rail_cache
+from src.utils import LRUCache
+
 
 
 WalkingElement = \
@@ -31,6 +36,140 @@ WalkingElement = \
 Waypoint = NamedTuple('Waypoint', [('position', Tuple[int, int]), ('direction', int)])
 
 
+class PredictionStore:
+    """
+    Predictions of all agents stored in preallocated arrays, reused across steps (reallocated only when the number
+    of agents or the prediction depth change). All attributes are views on the same buffers:
+
+    - cells: np.array of shape (num_agents, max_depth, 2), predicted cells (row, column)
+    - rows, cols: np.array of shape (num_agents, max_depth), views of cells
+    - positions: np.array of shape (num_agents, max_depth), predicted cells as int positions (as computed by
+    coordinate_to_position(env.width, cells))
+    - directions: np.array of shape (num_agents, max_depth), predicted directions
+    - is_predicted: np.array of shape (num_agents, max_depth), False for agents without prediction (DONE_REMOVED)
+
+    Cells, positions and directions are -1 where there is no prediction.
+    """
+
+    def __init__(self):
+        self._buffer = np.zeros((0, 0, 4), dtype=np.int32)
+        self.is_predicted = np.zeros((0, 0), dtype=bool)
+        self._set_views()
+
+    def _set_views(self):
+        self.cells = self._buffer[:, :, 0:2]
+        self.rows = self._buffer[:, :, 0]
+        self.cols = self._buffer[:, :, 1]
+        self.positions = self._buffer[:, :, 2]
+        self.directions = self._buffer[:, :, 3]
+
+    def update(self, prediction_tensor, max_depth, width):
+        """
+        Fill the store with the predictions of this step.
+        :param prediction_tensor: np.array of shape (num_agents, max_depth, 5), predictions of all agents as
+        computed by the predictor (ShortestPathPredictorForRailEnv.prediction_tensor)
+        :param max_depth: prediction depth
+        :param width: env width, used to convert cells to int positions
+        :return: 
+        """
+        num_agents = len(prediction_tensor)
+        if self._buffer.shape[:2] != (num_agents, max_depth):
+            self._buffer = np.zeros((num_agents, max_depth, 4), dtype=np.int32)
+            self.is_predicted = np.zeros((num_agents, max_depth), dtype=bool)
+            self._set_views()
+
+        # Columns are (row, column, direction) of each prediction step
+        predictions = prediction_tensor[:, :max_depth, 1:4].copy()
+        np.logical_not(np.isnan(predictions[:, :, 0]), out=self.is_predicted)
+        predictions[~self.is_predicted] = -1
+        self.cells[:] = predictions[:, :, 0:2]
+        self.directions[:] = predictions[:, :, 2]
+        # Same conversion of coordinate_to_position(), careful: not (y, x) but y + x * width
+        np.copyto(self.positions, np.where(self.is_predicted, self.cols * width + self.rows, -1))
+
+
+class OccupancyIntervals:
+    """
+    Predictions of all agents as occupancy intervals: each agent occupies each cell of its path from enter_ts to
+    exit_ts (both included), the last cell is occupied until the end of the prediction (max_depth - 1).
+    Intervals of all agents are stored in flat arrays, sorted by agent and by time, those of agent a are in the range
+    indptr[a]:indptr[a + 1]:
+
+    - agents: np.array of shape (num_intervals,), handle of the agent
+    - rows, cols, directions: np.array of shape (num_intervals,), cell and direction of the agent in the cell
+    - positions: np.array of shape (num_intervals,), cells as int positions (as computed by
+    coordinate_to_position(env.width, cells))
+    - enter_ts, exit_ts: np.array of shape (num_intervals,), first and last timestep in the cell
+    - indptr: np.array of shape (num_agents + 1,)
+
+    Agents without prediction (DONE_REMOVED) have no intervals.
+    """
+
+    def __init__(self, paths, stop_index, times_per_cell, is_removed, max_depth, width):
+        """
+        :param paths: np.array of shape (num_agents, max_depth + 1, 3), paths walked by the predictor
+        :param stop_index: np.array of shape (num_agents,), index of the cell of the path where each agent stops
+        :param times_per_cell: np.array of shape (num_agents,), timesteps spent by each agent in each cell
+        :param is_removed: np.array of shape (num_agents,), True for agents without prediction
+        :param max_depth: prediction depth
+        :param width: env width, used to convert cells to int positions
+        """
+        num_agents = len(paths)
+        path_index = np.arange(paths.shape[1])
+        stop_index = stop_index[:, np.newaxis]
+        times_per_cell = times_per_cell[:, np.newaxis]
+
+        # Cell i > 0 of the path is entered at (i - 1) * times_per_cell, agents that stop in their current cell
+        # (stop_index == 0) occupy it for the whole prediction
+        enter_ts = np.where(stop_index == 0, 0, (path_index - 1) * times_per_cell)
+        exit_ts = np.where(path_index == stop_index, max_depth - 1,
+                           np.minimum(path_index * times_per_cell - 1, max_depth - 1))
+        is_interval = np.where(stop_index == 0, path_index == 0,
+                               (path_index >= 1) & (path_index <= stop_index) & (enter_ts < max_depth))
+        is_interval &= ~is_removed[:, np.newaxis]
+
+        self.agents, steps = np.nonzero(is_interval)
+        self.rows, self.cols, self.directions = paths[self.agents, steps].T
+        self.positions = self.cols * width + self.rows
+        self.enter_ts = enter_ts[self.agents, steps]
+        self.exit_ts = exit_ts[self.agents, steps]
+        self.indptr = np.zeros(num_agents + 1, dtype=int)
+        np.cumsum(np.bincount(self.agents, minlength=num_agents), out=self.indptr[1:])
+
+    def find_conflicts(self, window=0):
+        """
+        Sweep-line over the intervals of each cell (sorted by enter_ts) to find pairs of agents predicted in the same
+        cell at the same time, or within window timesteps (e.g. window=1 to also detect an agent entering a cell
+        right after another one has left it, as with ts - 1 and ts + 1 in GraphObsForRailEnv._possible_conflict()).
+        The cost is O(num_intervals * log(num_intervals) + num_conflicts), independent of the prediction depth.
+        :param window: max number of timesteps between the intervals of two agents to be considered in conflict
+        :return: np.array of shape (num_conflicts, 5), for each conflict the handle of the agent that enters the cell
+        first, the handle of the other agent, the int position of the cell and the first and last timestep when both
+        agents are in the cell (last < first if they are not in the cell at the same time, but within window)
+        """
+        order = np.lexsort((self.enter_ts, self.positions)).tolist()
+        agents = self.agents.tolist()
+        positions = self.positions.tolist()
+        enter_ts = self.enter_ts.tolist()
+        exit_ts = self.exit_ts.tolist()
+
+        conflicts = []
+        current_position = None
+        active = []  # Intervals of the current cell that can still overlap with the next ones
+        for i in order:
+            if positions[i] != current_position:
+                current_position = positions[i]
+                active = []
+            else:
+                active = [k for k in active if exit_ts[k] + window >= enter_ts[i]]
+            for k in active:
+                if agents[k] != agents[i]:
+                    conflicts.append((agents[k], agents[i], current_position,
+                                      enter_ts[i], min(exit_ts[k], exit_ts[i])))
+            active.append(i)
+        return np.array(conflicts, dtype=int).reshape((-1, 5))
+
+
 # TODO 'Add action taken to come here' info
 
 class ShortestPathPredictorForRailEnv(PredictionBuilder):
@@ -41,96 +180,289 @@ class ShortestPathPredictorForRailEnv(PredictionBuilder):
     The prediction acts as if no other agent is in the environment and always takes the forward action.
     """
 
-    def __init__(self, max_depth: int = 20):
+    def __init__(self, max_depth: int = 20, show_predictions: bool = False, incremental: bool = False,
+                 k_shortest_paths_cache_size: int = 1024):
+        """
+        :param max_depth: prediction depth
+        :param show_predictions: if True set env.dev_pred_dict at each get(), used by the renderer to draw predictions
+        :param incremental: if True the shortest path of each agent is kept across steps and shifted by the progress
+        of the agent, it is recomputed only when the agent leaves it (see _advance_plans())
+        :param k_shortest_paths_cache_size: max number of results of get_k_shortest_paths() kept in cache
+        """
         super().__init__(max_depth)
+        self.show_predictions = show_predictions
+        self.incremental = incremental
+        # Results of get_k_shortest_paths() for (source position, source direction, target position, k) on the rail
+        # with content hash k_shortest_paths_grid_hash, kept across steps and episodes until the map changes (a new
+        # rail object is built at each env.reset(), even when the same map is loaded again)
+        self.k_shortest_paths_cache = LRUCache(maxsize=k_shortest_paths_cache_size)
+        self.k_shortest_paths_rail = None
+        self.k_shortest_paths_grid_hash = None
+        self.shortest_paths = None
+        # Incremental mode: waypoint (row, column, direction) and status of each agent when its path (in self.paths)
+        # was last computed or advanced, distance maps of the targets of the episode
+        self.plan_waypoints = np.zeros((0, 3), dtype=int)
+        self.plan_status = np.zeros(0, dtype=int)
+        self.plans_distance_map = None
+        self.num_recomputed = 0  # Number of paths recomputed in the last get()
+        self.recompute_count = 0  # Number of paths recomputed since the predictor was created
+        self.prediction_count = 0  # Number of paths predicted (recomputed or advanced) since the predictor was created
+        # np.array of shape (num_agents, max_depth, 5), predictions of all agents computed in the last get()
+        self.prediction_tensor = np.zeros((0, max_depth, 5))
+        # Paths walked in the last get() and their lengths, see _walk_paths(), index of the cell where each agent
+        # stops, steps spent by each agent in each cell and mask of agents without prediction, used to build occupancy
+        # intervals
+        self.paths = np.zeros((0, max_depth + 1, 3), dtype=int)
+        self.path_lengths = np.zeros(0, dtype=int)
+        self.stop_index = np.zeros(0, dtype=int)
+        self.times_per_cell = np.zeros(0, dtype=int)
+        self.is_removed = np.zeros(0, dtype=bool)
+
+    def reset(self):
+        """
+        Called after each environment reset, drops the paths of the previous episode.
+        :return:
+        """
+        self.plans_distance_map = None
 
-    def get(self, handle: int = None):
+    def _get_virtual_positions(self, agents):
+        """
+        Current cell and direction of each agent, as arrays.
+        :param agents: env.agents
+        :return: np.array of shape (num_agents, 3) with (row, column, direction) of each agent, np.array of shape
+        (num_agents,) True for agents without prediction (DONE_REMOVED)
+        """
+        virtual_positions = np.zeros((len(agents), 3), dtype=int)
+        is_removed = np.zeros(len(agents), dtype=bool)
+        for agent in agents:
+            if agent.status == RailAgentStatus.READY_TO_DEPART:
+                agent_virtual_position = agent.initial_position
+            elif agent.status == RailAgentStatus.ACTIVE:
+                agent_virtual_position = agent.position
+            elif agent.status == RailAgentStatus.DONE:
+                agent_virtual_position = agent.target
+            else:  # agent.status == DONE_REMOVED, prediction must be None
+                is_removed[agent.handle] = True
+                continue
+            virtual_positions[agent.handle] = (*agent_virtual_position, agent.direction)
+        return virtual_positions, is_removed
+
+    def _walk_paths(self, agents, virtual_positions, is_removed):
+        """
+        Walk the shortest paths of all agents at once with walk_shortest_paths(), the result is the same of
+        get_shortest_paths(distance_map, max_depth) as arrays.
+        :param agents: env.agents
+        :param virtual_positions: np.array of shape (num_agents, 3), as returned by _get_virtual_positions()
+        :param is_removed: np.array of shape (num_agents,), as returned by _get_virtual_positions()
+        :return: np.array of shape (num_agents, max_depth + 1, 3) with (row, column, direction) of the path, where
+        [:, 0] is the current cell, filled with the last cell of each path, np.array of shape (num_agents,) with the
+        length of each path (current cell excluded)
+        """
+        walked, num_moves, has_path = walk_shortest_paths(self.env.rail, agents, virtual_positions, is_removed,
+                                                          self.max_depth)
+        # get_shortest_paths() returns num_moves + 1 elements (the last one is STOP_MOVING at the target) if the target
+        # is reached within max_depth moves, max_depth elements otherwise, and the path starts from the second one
+        path_lengths = np.where(num_moves < self.max_depth, num_moves, self.max_depth - 1)
+        path_lengths[~has_path] = 0
+        path_index = np.minimum(np.arange(self.max_depth + 1), path_lengths[:, np.newaxis])
+        paths = np.take_along_axis(walked, path_index[..., np.newaxis], axis=1)
+        return paths, path_lengths
+
+    def get(self, handle: int = None, replan_handles=None):
         """
         Requires distance_map to extract the shortest path.
         Does not take into account future positions of other agents!
 
         If there is no shortest path, the agent just stands still and stops moving.
 
+        Predictions of all agents are computed at once in self.prediction_tensor, each path is walked by
+        times_per_cell steps per cell (the speed of the agent) until the target or the end of the path is reached,
+        then the agent stops moving.
+
         Parameters
         ----------
         handle : int, optional
             Handle of the agent for which to compute the observation vector.
+        replan_handles : set, optional
+            Handles of the agents whose paths must be walked again (e.g. affected by an event), the paths of the other
+            agents are advanced from the previous step as in incremental mode (see _advance_plans()).
 
         Returns
         -------
         np.array
-            Returns a dictionary indexed by the agent handle and for each agent a vector of (max_depth + 1)x5 elements:
+            Returns a dictionary indexed by the agent handle and for each agent a vector of max_depthx5 elements
+            (a view of self.prediction_tensor):
             - time_offset
             - position axis 0
             - position axis 1
             - direction
             - action taken to come here - my implementation
-            The prediction at 0 is the current position, direction etc.
+            The prediction at 0 is the first step after the current position.
+            Agents DONE_REMOVED have nan (no prediction) in all but the time_offset column.
         """
         agents = self.env.agents
-        if handle:
-            agents = [self.env.agents[handle]]
-        distance_map: DistanceMap = self.env.distance_map
 
-        shortest_paths = get_shortest_paths(distance_map, max_depth=self.max_depth)
-        self.shortest_paths = shortest_paths
-        prediction_dict = {}
-        for agent in agents:
+        virtual_positions, is_removed = self._get_virtual_positions(agents)
+        if self.incremental or replan_handles is not None:
+            paths, path_lengths = self._advance_plans(agents, virtual_positions, is_removed, replan_handles)
+        else:
+            paths, path_lengths = self._walk_paths(agents, virtual_positions, is_removed)
+        # Computed on demand by get_shortest_paths()
+        self.shortest_paths = None
+        targets = np.array([agent.target for agent in agents], dtype=int).reshape((-1, 2))
+        times_per_cell = np.array([int(np.reciprocal(agent.speed_data["speed"])) for agent in agents], dtype=int)
+
+        # Index of the cell where the agent stops: the first cell of the path that is its target or the last one
+        steps = np.arange(self.max_depth + 1)
+        is_stop = np.all(paths[:, :, 0:2] == targets[:, np.newaxis], axis=2) | (steps == path_lengths[:, np.newaxis])
+        stop_index = np.argmax(is_stop, axis=1)
+
+        # Each cell is repeated times_per_cell times: at step ts the agent has entered the (ts // times_per_cell + 1)-th
+        # cell of the path, and it stops moving from the step after the stop cell has been reached
+        ts = steps[:-1]
+        path_index = ts // times_per_cell[:, np.newaxis] + 1
+        previous_path_index = np.where(ts == 0, 0, (ts - 1) // times_per_cell[:, np.newaxis] + 1)
+        is_stopped = previous_path_index >= stop_index[:, np.newaxis]
+        path_index = np.where(is_stopped, stop_index[:, np.newaxis], path_index)
+
+        if self.prediction_tensor.shape != (len(agents), self.max_depth, 5):
+            self.prediction_tensor = np.zeros((len(agents), self.max_depth, 5))
+        prediction_tensor = self.prediction_tensor
+        prediction_tensor[:, :, 0] = ts
+        prediction_tensor[:, :, 1:4] = paths[np.arange(len(agents))[:, np.newaxis], path_index]
+        prediction_tensor[:, :, 4] = np.where(is_stopped, RailEnvActions.STOP_MOVING, 0)
+        prediction_tensor[is_removed, :, 1:] = np.nan
+
+        self.paths = paths
+        self.path_lengths = path_lengths
+        self.stop_index = stop_index
+        self.times_per_cell = times_per_cell
+        self.is_removed = is_removed
+
+        if self.show_predictions:
+            self._set_dev_pred_dict(agents, is_removed, is_stopped)
+
+        if handle is not None:
+            return {handle: prediction_tensor[handle]}
+        return {agent.handle: prediction_tensor[agent.handle] for agent in agents}
+
+    def get_occupancy_intervals(self):
+        """
+        Predictions computed in the last get() as occupancy intervals, one for each cell walked instead of one row for
+        each timestep.
+        :return: OccupancyIntervals
+        """
+        return OccupancyIntervals(self.paths, self.stop_index, self.times_per_cell, self.is_removed,
+                                  self.max_depth, self.env.width)
 
-            if agent.status == RailAgentStatus.READY_TO_DEPART:
-                agent_virtual_position = agent.initial_position
-            elif agent.status == RailAgentStatus.ACTIVE:
-                agent_virtual_position = agent.position
-            elif agent.status == RailAgentStatus.DONE:
-                agent_virtual_position = agent.target
-            else:  # agent.status == DONE_REMOVED, prediction must be None
-                prediction = np.zeros(shape=(self.max_depth + 1, 5))
-                for i in range(self.max_depth):
-                    prediction[i] = [i, None, None, None, None]
-                prediction_dict[agent.handle] = prediction
+    def _advance_plans(self, agents, virtual_positions, is_removed, replan_handles=None):
+        """
+        Incremental version of _walk_paths(): each agent keeps its path from the previous step, the path is shifted by
+        one cell if the agent has moved to the next cell of its path (and extended by one move if it was cut at
+        max_depth), kept as is if the agent has not moved (e.g. malfunctioning or slow agents) and walked again with
+        walk_shortest_paths() if the agent has deviated from it (e.g. taking another branch at a switch) or its status
+        has changed (e.g. departing).
+        Since on the distance maps of the targets each move of a shortest path decreases the distance by one, the walk
+        from the next cell of a path follows the rest of the path, and the result is the same of _walk_paths().
+        :param agents: env.agents
+        :param virtual_positions: np.array of shape (num_agents, 3), as returned by _get_virtual_positions()
+        :param is_removed: np.array of shape (num_agents,), as returned by _get_virtual_positions()
+        :param replan_handles: set of handles of the agents whose paths are walked again anyway, None if only agents
+        that left their path (or changed status) have to be walked again
+        :return: np.array of shape (num_agents, max_depth + 1, 3), np.array of shape (num_agents,), as returned by
+        _walk_paths()
+        """
+        distance_map = get_target_distance_maps(self.env.rail, agents)
+        status = np.array([agent.status for agent in agents], dtype=int)
+        num_agents = len(agents)
+        # New episode
+        if distance_map is not self.plans_distance_map or self.paths.shape != (num_agents, self.max_depth + 1, 3):
+            paths, path_lengths = self._walk_paths(agents, virtual_positions, is_removed)
+            is_recomputed = np.ones(num_agents, dtype=bool)
+        else:
+            paths = self.paths.copy()
+            path_lengths = self.path_lengths.copy()
+            is_same_status = status == self.plan_status
+            has_stayed = is_same_status & np.all(virtual_positions == self.plan_waypoints, axis=1)
+            has_advanced = is_same_status & ~has_stayed & (path_lengths > 0) & \
+                np.all(virtual_positions == paths[:, 1], axis=1)
+
+            advanced = np.flatnonzero(has_advanced)
+            paths[advanced, :-1] = paths[advanced, 1:]
+            path_lengths[advanced] -= 1
+            if self.max_depth > 1:
+                # Paths cut at max_depth (the last cell is not the target) are extended by one move, as in
+                # walk_shortest_paths() the walk must also be able to make the move after it (unless it is the target)
+                targets = distance_map.targets[distance_map.agent_targets]
+                last = paths[advanced, self.max_depth - 2]
+                is_cut = (path_lengths[advanced] == self.max_depth - 2) & \
+                    np.any(last[:, 0:2] != targets[advanced], axis=1)
+                advanced, last = advanced[is_cut], last[is_cut]
+                # With max_depth 2 the last cell is the current one, where the walk starts
+                next_waypoints, is_moving = self._walk_one_move(distance_map, advanced, last, self.max_depth == 2)
+                is_target = np.all(next_waypoints[:, 0:2] == targets[advanced], axis=1)
+                is_moving[~is_target] &= self._walk_one_move(distance_map, advanced[~is_target],
+                                                             next_waypoints[~is_target])[1]
+                has_advanced[advanced[~is_moving]] = False
+                advanced, next_waypoints = advanced[is_moving], next_waypoints[is_moving]
+                paths[advanced, self.max_depth - 1:] = next_waypoints[:, np.newaxis]
+                path_lengths[advanced] += 1
+
+            is_recomputed = ~(has_stayed | has_advanced)
+            if replan_handles:
+                is_recomputed[list(replan_handles)] = True
+            if np.any(is_recomputed):
+                walked_paths, walked_lengths = self._walk_paths(agents, virtual_positions, is_removed | ~is_recomputed)
+                paths[is_recomputed] = walked_paths[is_recomputed]
+                path_lengths[is_recomputed] = walked_lengths[is_recomputed]
+
+        self.plan_waypoints = virtual_positions
+        self.plan_status = status
+        self.plans_distance_map = distance_map
+        self.num_recomputed = int(np.count_nonzero(is_recomputed))
+        self.recompute_count += self.num_recomputed
+        self.prediction_count += num_agents
+        return paths, path_lengths
+
+    def _walk_one_move(self, distance_map, handles, waypoints, is_first_move=False):
+        """
+        One move of the walk of walk_shortest_paths() from the waypoints of the given agents.
+        :param distance_map: TargetDistanceMaps of the env
+        :param handles: np.array of shape (num_handles,), agents ids
+        :param waypoints: np.array of shape (num_handles, 3), (row, column, direction) of the agents
+        :param is_first_move: if True the walk starts from the waypoints, so any move with finite distance is valid
+        :return: np.array of shape (num_handles, 3), next waypoint of each agent, np.array of shape (num_handles,),
+        False if no move decreases the distance from the target (the walk would stop without path)
+        """
+        rail_cache = get_rail_cache(self.env.rail)
+        flat_waypoints = (waypoints[:, 0] * rail_cache.width + waypoints[:, 1]) * 4 + waypoints[:, 2]
+        agent_targets = distance_map.agent_targets[handles]
+        next_waypoints = rail_cache.move_waypoints[flat_waypoints]
+        distances = distance_map.flat_distances[agent_targets[:, np.newaxis], next_waypoints]
+        best = np.argmin(distances, axis=1)
+        max_distances = np.inf if is_first_move else distance_map.flat_distances[agent_targets, flat_waypoints]
+        is_moving = distances[np.arange(len(handles)), best] < max_distances
+        cells, directions = np.divmod(next_waypoints[np.arange(len(handles)), best], 4)
+        rows, cols = np.divmod(cells, rail_cache.width)
+        return np.stack((rows, cols, directions), axis=1), is_moving
+
+    def _set_dev_pred_dict(self, agents, is_removed, is_stopped):
+        """
+        Set env.dev_pred_dict (cells and directions of each prediction) for visualization only.
+        :param agents: env.agents
+        :param is_removed: np.array of shape (num_agents,), True for agents without prediction
+        :param is_stopped: np.array of shape (num_agents, max_depth), True where the agent stops moving
+        :return:
+        """
+        for agent in agents:
+            if is_removed[agent.handle]:
                 continue
-
-            agent_virtual_direction = agent.direction
-            agent_speed = agent.speed_data["speed"]
-            times_per_cell = int(np.reciprocal(agent_speed))
-            prediction = np.zeros(shape=(self.max_depth + 1, 5))
-            # First cell is info relative to actual timestep, but I don't need this one TODO
-            #prediction[0] = [0, *agent_virtual_position, agent_virtual_direction, 0]
-
-            shortest_path = shortest_paths[agent.handle]
-
-            # If there is a shortest path, remove the initial position
-            if shortest_path:
-                shortest_path = shortest_path[1:]
-
-            new_direction = agent_virtual_direction
-            new_position = agent_virtual_position
             visited = OrderedSet()
-            for index in range(self.max_depth):
-                # If we're at the target or not moving, stop moving until max_depth is reached
-                # TODO Changing this to avoid stuck agent
-                #if new_position == agent.target or not agent.moving or not shortest_path:
-                if new_position == agent.target or not shortest_path:
-                    prediction[index] = [index, *new_position, new_direction, RailEnvActions.STOP_MOVING]
-                    visited.add((*new_position, agent.direction))
-                    continue
-
-                if index % times_per_cell == 0:
-
-                    new_position = shortest_path[0].position
-                    new_direction = shortest_path[0].direction
-
-                    shortest_path = shortest_path[1:]
-
-                # Prediction is ready
-                prediction[index] = [index, *new_position, new_direction, 0]
-                visited.add((*new_position, new_direction))
-
-            # TODO: very bady side effects for visualization only: hand the dev_pred_dict back instead of setting on env!
+            for step, stopped in zip(self.prediction_tensor[agent.handle].astype(int).tolist(),
+                                     is_stopped[agent.handle]):
+                # Stopped agents keep their current direction
+                visited.add((step[1], step[2], agent.direction if stopped else step[3]))
             self.env.dev_pred_dict[agent.handle] = visited
-            prediction_dict[agent.handle] = prediction
-
-        return prediction_dict
 
     '''
     Given prediction dict for all agents, return sequence of cells walked in the prediction as a dict
@@ -153,6 +485,8 @@ class ShortestPathPredictorForRailEnv(PredictionBuilder):
         return self.max_depth
 
     def get_shortest_paths(self):
+        if self.shortest_paths is None:
+            self.shortest_paths = get_shortest_paths(self.env.distance_map, max_depth=self.max_depth)
         return self.shortest_paths
 
     def get_k_shortest_paths(self,
@@ -163,7 +497,12 @@ class ShortestPathPredictorForRailEnv(PredictionBuilder):
         """
         Computes the k shortest paths using modified Dijkstra
         following pseudo-code https://en.wikipedia.org/wiki/K_shortest_path_routing
+        Results are cached (see k_shortest_paths_cache), only the first call for a given source waypoint, target and k
+        on the same map computes the paths.
         In contrast to the pseudo-code in wikipedia, we do not a allow for loopy paths.
+        Paths in B are kept in a binary heap ordered by (cost, insertion order), so that among paths with the same cost
+        the first inserted is expanded first (as in Flatland implementation), and counts are allocated only for the
+        waypoints actually reached.
 
         Parameters
         ----------
@@ -183,40 +522,70 @@ class ShortestPathPredictorForRailEnv(PredictionBuilder):
             We use a list of paths in order to keep the order of length.
         """
 
+        rail_cache = get_rail_cache(self.env.rail)
+
+        # A new rail cache is built whenever the rail changes, cached paths are dropped only if the map is different
+        if rail_cache is not self.k_shortest_paths_rail:
+            grid_hash = self._get_grid_hash(rail_cache.grid)
+            if grid_hash != self.k_shortest_paths_grid_hash:
+                self.k_shortest_paths_cache.clear()
+                self.k_shortest_paths_grid_hash = grid_hash
+            self.k_shortest_paths_rail = rail_cache
+        key = (tuple(source_position), source_direction, tuple(target_position), k)
+        cached_paths = self.k_shortest_paths_cache.get(key)
+        if cached_paths is not None:
+            return list(cached_paths)
+
+        shortest_paths = self._compute_k_shortest_paths(rail_cache, source_position, source_direction,
+                                                        target_position, k, debug)
+        self.k_shortest_paths_cache.put(key, tuple(shortest_paths))
+        return shortest_paths
+
+    @staticmethod
+    def _get_grid_hash(grid):
+        """
+        :param grid: rail.grid of the env
+        :return: hex digest of the content of the grid (shape and transitions of each cell)
+        """
+        grid = np.ascontiguousarray(grid, dtype=np.uint16)
+        grid_hash = hashlib.sha1(np.array(grid.shape, dtype=np.int64).tobytes())
+        grid_hash.update(grid.tobytes())
+        return grid_hash.hexdigest()
+
+    def _compute_k_shortest_paths(self, rail_cache, source_position, source_direction, target_position, k, debug):
+        """
+        Search of the k shortest paths, see get_k_shortest_paths().
+        :param rail_cache: RailCache of the env rail
+        :return: list of paths as tuples of Waypoint
+        """
         # P: set of shortest paths from s to t
         # P =empty,
         shortest_paths: List[Tuple[Waypoint]] = []
 
         # countu: number of shortest paths found to node u
-        # countu = 0, for all u in V
-        count = {(r, c, d): 0 for r in range(self.env.height) for c in range(self.env.width) for d in range(4)}
+        # countu = 0, for all u in V (allocated when u is first reached)
+        count = defaultdict(int)
 
-        # B is a heap data structure containing paths
-        # N.B. use OrderedSet to make result deterministic!
-        heap: OrderedSet[Tuple[Waypoint]] = OrderedSet()
+        # B is a heap data structure containing paths as (cost, insertion order, path)
+        # N.B. use the insertion order to break ties and make result deterministic!
+        heap: List[Tuple[int, int, Tuple[Waypoint]]] = []
+        insertion_order = 0
 
         # insert path Ps = {s} into B with cost 0
-        heap.add((Waypoint(source_position, source_direction),))
+        heapq.heappush(heap, (1, insertion_order, (Waypoint(source_position, source_direction),)))
 
         # while B is not empty and countt < K:
         while len(heap) > 0 and len(shortest_paths) < k:
             if debug:
                 print("iteration heap={}, shortest_paths={}".format(heap, shortest_paths))
             # – let Pu be the shortest cost path in B with cost C
-            cost = np.inf
-            pu = None
-            for path in heap:
-                if len(path) < cost:
-                    pu = path
-                    cost = len(path)
+            #     – B = B − {Pu }
+            cost, _, pu = heapq.heappop(heap)
             u: Waypoint = pu[-1]
             if debug:
                 print("  looking at pu={}".format(pu))
 
-            #     – B = B − {Pu }
-            heap.remove(pu)
             #     – countu = countu + 1
-
             urcd = (*u.position, u.direction)
             count[urcd] += 1
 
@@ -229,7 +598,7 @@ class ShortestPathPredictorForRailEnv(PredictionBuilder):
             # – if countu ≤ K then
             # CAVEAT: do not allow for loopy paths
             elif count[urcd] <= k:
-                possible_transitions = self.env.rail.get_transitions(*urcd)
+                possible_transitions = rail_cache.transitions[urcd]
                 if debug:
                     print("  looking at neighbors of u={}, transitions are {}".format(u, possible_transitions))
                 #     for each vertex v adjacent to u:
@@ -249,7 +618,8 @@ class ShortestPathPredictorForRailEnv(PredictionBuilder):
                         # – let Pv be a new path with cost C + w(u, v) formed by concatenating edge (u, v) to path Pu
                         pv = pu + (v,)
                         #     – insert Pv into B
-                        heap.add(pv)
+                        insertion_order += 1
+                        heapq.heappush(heap, (cost + 1, insertion_order, pv))
 
         # return P
         return shortest_paths
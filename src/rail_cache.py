@@ -0,0 +1,82 @@
+"""
+Cache of the rail of a RailEnv, built once per rail with array operations and shared by observation builders,
+predictors and controllers, so that hot loops don't need to call rail.get_transitions() one cell at a time.
+"""
+
+import weakref
+
+import numpy as np
+
+# Bitmap of the diamond crossing, the only fork where no transition has more than one possible exit
+DIAMOND_CROSSING = int('1000010000100001', 2)
+
+# Cell offset of a step towards each direction (North, East, South, West), as in get_new_position()
+MOVEMENTS = np.array([[-1, 0], [0, 1], [1, 0], [0, -1]])
+
+# Cache of each rail (GridTransitionMap), dropped together with the rail
+_rail_caches = weakref.WeakKeyDictionary()
+
+
+class RailCache:
+    """
+    Dense NumPy view of the rail transitions:
+
+    - rail_planes: np.array of shape (height, width, 16) of uint8, bits of the 16 bits transition bitmap of each cell,
+    from the most significant one
+    - transitions: np.array of shape (height, width, 4, 4), view of rail_planes, transitions[row, col, direction] is
+    equal to rail.get_transitions(row, col, direction), namely 1 where the agent facing direction can exit the cell
+    towards the direction along the last axis
+    - rail_mask: np.array of shape (height, width), True if the cell contains rails
+    - dead_end_mask: np.array of shape (height, width), True if the cell is a dead-end (as in rail.is_dead_end())
+    - switch_mask: np.array of shape (height, width), True if for some direction more than one transition is possible
+    - crossing_mask: np.array of shape (height, width), True if the cell is a diamond crossing
+    - move_exits: np.array of shape (height, width, 4, 3), exit directions of the moves considered by
+    get_valid_move_actions_() for the agent in (row, column) with the given direction, in order: left, forward and
+    right, or the U-turn (and two invalid moves) in dead-ends
+    - move_mask: np.array of shape (height, width, 4, 3), True where the move in move_exits is valid
+    - move_waypoints: np.array of shape (height * width * 4, 3), waypoint reached by each move in move_exits from the
+    waypoint with flat index (row * width + column) * 4 + direction, as flat index, -1 where the move is not valid
+    """
+
+    def __init__(self, rail):
+        # Keep a reference to the grid to detect when the rail is replaced
+        self.grid = rail.grid
+        grid = rail.grid.astype(np.uint16)
+        self.height, self.width = grid.shape
+
+        # Bit 15 - (4 * direction + exit_direction) of the cell bitmap tells whether the transition is allowed:
+        # bitmaps are unpacked from their big-endian bytes, so that bits are in this order
+        self.rail_planes = np.unpackbits(grid.astype('>u2').view(np.uint8).reshape((self.height, self.width, 2)),
+                                         axis=2)
+        self.transitions = self.rail_planes.reshape((self.height, self.width, 4, 4))
+
+        num_transitions = self.transitions.sum(axis=(2, 3))
+        self.rail_mask = num_transitions > 0
+        self.dead_end_mask = num_transitions == 1
+        self.switch_mask = np.any(self.transitions.sum(axis=3) > 1, axis=2)
+        self.crossing_mask = grid == DIAMOND_CROSSING
+
+        directions = np.arange(4)
+        self.move_exits = np.tile((directions[:, np.newaxis] + np.array([-1, 0, 1])) % 4,
+                                  (self.height, self.width, 1, 1))
+        self.move_exits[self.dead_end_mask] = ((directions + 2) % 4)[:, np.newaxis]
+        self.move_mask = np.take_along_axis(self.transitions, self.move_exits, axis=3).astype(bool)
+        self.move_mask[self.dead_end_mask, :, 1:] = False
+        next_rows = np.arange(self.height)[:, np.newaxis, np.newaxis, np.newaxis] + MOVEMENTS[self.move_exits, 0]
+        next_cols = np.arange(self.width)[np.newaxis, :, np.newaxis, np.newaxis] + MOVEMENTS[self.move_exits, 1]
+        self.move_waypoints = np.where(self.move_mask, (next_rows * self.width + next_cols) * 4 + self.move_exits, -1)\
+            .reshape((-1, 3))
+
+
+def get_rail_cache(rail):
+    """
+    Return the RailCache of the rail, it is built the first time that this rail (or a new grid for this rail) is seen,
+    e.g. at the first reset() of an episode, and then shared by all its users.
+    :param rail: GridTransitionMap of the env
+    :return: RailCache
+    """
+    rail_cache = _rail_caches.get(rail)
+    if rail_cache is None or rail_cache.grid is not rail.grid:
+        rail_cache = RailCache(rail)
+        _rail_caches[rail] = rail_cache
+    return rail_cache
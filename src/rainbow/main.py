@@ -95,7 +95,8 @@ def main(args):
 					   'max_duration': args.max_duration  # Max duration of malfunction
 					   }
 	
-	observation_builder = GraphObsForRailEnv(predictor=ShortestPathPredictorForRailEnv(max_depth=args.prediction_depth))
+	observation_builder = GraphObsForRailEnv(predictor=ShortestPathPredictorForRailEnv(max_depth=args.prediction_depth, incremental=True),
+	                                         only_action_required=True)
 	
 	# Construct the environment with the given observation, generators, predictors, and stochastic data
 	env = RailEnv(width=args.width,
@@ -31,7 +31,7 @@ def test(args, T, ep, dqn, val_mem, metrics, results_dir, evaluate=False):
 
     schedule_generator = sparse_schedule_generator(speed_ration_map)
 
-    observation_builder = GraphObsForRailEnv(predictor=ShortestPathPredictorForRailEnv(max_depth=args.prediction_depth))
+    observation_builder = GraphObsForRailEnv(predictor=ShortestPathPredictorForRailEnv(max_depth=args.prediction_depth, show_predictions=True))
 
     env = RailEnv(
                 width=args.width,
@@ -0,0 +1,78 @@
+"""
+Detection of the events that invalidate the plans of the agents between two consecutive steps, used to rebuild
+observations only for the agents affected by them (between events agents just move along their predicted paths).
+"""
+
+import numpy as np
+
+from flatland.envs.agent_utils import RailAgentStatus
+
+
+class ReplanningScheduler:
+    """
+    Compare consecutive env states and select the agents to recompute:
+
+    - events: np.array of shape (num_agents,), True for agents with an event in the last step, namely a malfunction
+    started or ended, the status changed (e.g. departed or reached the target), entered a switch or stopped
+    - recompute: set of handles of the agents to recompute, agents with an event and agents whose reservations overlap
+    the ones (before or after the step) of an agent with an event
+    - recomputed_fractions: list of the fractions of agents recomputed at each step
+    """
+
+    def __init__(self):
+        self.status = None
+        self.malfunction = None
+        self.positions = None
+        self.moving = None
+        self.events = np.zeros(0, dtype=bool)
+        self.recompute = set()
+        self.recomputed_fractions = []
+
+    def reset(self):
+        """
+        Forget the previous state, e.g. at the beginning of an episode, so that all agents are recomputed.
+        :return:
+        """
+        self.status = None
+
+    def detect_events(self, agents, agents_status, switch_mask):
+        """
+        Compare the current state of the agents with the one of the previous call.
+        :param agents: env.agents
+        :param agents_status: AgentStatusIndex, already updated for the current step
+        :param switch_mask: np.array of shape (env.height, env.width), True for switches (see RailCache)
+        :return: set of handles of agents with an event (all at the first call)
+        """
+        positions = np.array([agent.position if agent.position is not None else (-1, -1) for agent in agents],
+                             dtype=int).reshape((-1, 2))
+        moving = np.array([agent.moving for agent in agents], dtype=bool)
+        status = agents_status.status
+        malfunction = agents_status.malfunction
+
+        if self.status is None or len(self.status) != len(agents):
+            self.events = np.ones(len(agents), dtype=bool)
+        else:
+            is_active = status == RailAgentStatus.ACTIVE
+            has_moved = np.any(positions != self.positions, axis=1)
+            self.events = (self.malfunction == 0) != (malfunction == 0)
+            self.events |= status != self.status
+            self.events |= is_active & has_moved & switch_mask[positions[:, 0], positions[:, 1]]
+            self.events |= is_active & self.moving & ~moving
+
+        self.status = status
+        self.malfunction = malfunction
+        self.positions = positions
+        self.moving = moving
+        self.recompute = set(np.flatnonzero(self.events).tolist())
+        return self.recompute
+
+    def add_overlapping(self, reservations):
+        """
+        Add to the agents to recompute those whose reservations overlap the ones of agents with an event, must be
+        called after detect_events(), e.g. before and after the reservations are updated with the new predictions.
+        :param reservations: ReservationTable
+        :return: set of handles of the agents to recompute
+        """
+        for a in np.flatnonzero(self.events).tolist():
+            self.recompute |= reservations.get_overlapping(a)
+        return self.recompute
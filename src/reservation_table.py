@@ -0,0 +1,111 @@
+"""
+Rolling time-expanded reservation table, filled with the predictions of all agents and shared by observation builders
+and controllers, so that questions like "is this cell free at ts" or "who holds this cell at ts" are answered with a
+single lookup instead of comparing the predictions of each pair of agents.
+"""
+
+import numpy as np
+
+_NO_HOLDERS = frozenset()
+
+
+class ReservationTable:
+    """
+    For each of the next horizon timesteps and each cell (as int position, e.g. PredictionStore.positions) the set of
+    agents predicted to hold it.
+    Timesteps are stored in a ring buffer of horizon slots, timestep ts (relative to the current step, 0 is the first
+    predicted step) is in slot (time + ts) % horizon: moving to the next step just rotates the slots and predictions are
+    written incrementally, namely only reservations that differ from the ones of the previous step are updated (agents
+    moving along their path keep all their reservations but the last one).
+
+    - holders: dict (slot, position) : set of handles
+    - reserved: np.array of shape (num_agents, horizon), position reserved by each agent in each slot, -1 if none
+    - time: number of updates since the last reset, used to rotate the slots
+    - num_updated: number of reservations changed by the last update
+    """
+
+    def __init__(self):
+        self.holders = {}
+        self.reserved = np.full((0, 0), -1, dtype=int)
+        self.time = 0
+        self.num_updated = 0
+
+    @property
+    def horizon(self):
+        return self.reserved.shape[1]
+
+    def reset(self):
+        """
+        Drop all reservations, e.g. at the beginning of an episode.
+        :return:
+        """
+        self.holders = {}
+        self.reserved = np.full((0, 0), -1, dtype=int)
+        self.time = 0
+        self.num_updated = 0
+
+    def update(self, positions):
+        """
+        Move to the next step and write the reservations of all agents.
+        :param positions: np.array of shape (num_agents, horizon), predicted positions of each agent for the next
+        horizon timesteps, -1 where there is no prediction
+        :return:
+        """
+        if self.reserved.shape != positions.shape:
+            self.reset()
+            self.reserved = np.full(positions.shape, -1, dtype=int)
+        else:
+            self.time += 1
+
+        slots = (self.time + np.arange(self.horizon)) % self.horizon
+        previous = self.reserved[:, slots]
+        agents, ts = np.nonzero(previous != positions)
+        for a, slot, old_position, new_position in zip(agents.tolist(), slots[ts].tolist(),
+                                                       previous[agents, ts].tolist(), positions[agents, ts].tolist()):
+            if old_position != -1:
+                holders = self.holders[(slot, old_position)]
+                holders.discard(a)
+                if not holders:
+                    del self.holders[(slot, old_position)]
+            if new_position != -1:
+                self.holders.setdefault((slot, new_position), set()).add(a)
+        self.reserved[:, slots] = positions
+        self.num_updated = len(agents)
+
+    def get_holders(self, position, ts):
+        """
+        :param position: int position of the cell
+        :param ts: timestep, relative to the current step (0 <= ts < horizon)
+        :return: set of handles of the agents that hold the cell at ts (not to be modified)
+        """
+        return self.holders.get(((self.time + ts) % self.horizon, position), _NO_HOLDERS)
+
+    def is_free(self, position, ts, handle=None):
+        """
+        :param position: int position of the cell
+        :param ts: timestep, relative to the current step (0 <= ts < horizon)
+        :param handle: agent whose own reservations are ignored, if any
+        :return: True if no agent (but handle) holds the cell at ts
+        """
+        holders = self.get_holders(position, ts)
+        return not holders or (len(holders) == 1 and handle in holders)
+
+    def get_overlapping(self, handle, window=1):
+        """
+        Agents whose reservations overlap the ones of handle, namely that hold some cell reserved by handle within
+        window timesteps (as with ts - 1 and ts + 1 in GraphObsForRailEnv._possible_conflict()).
+        :param handle: agent id
+        :param window: max number of timesteps between two reservations of the same cell to be considered overlapping
+        :return: set of handles
+        """
+        overlapping = set()
+        if handle >= len(self.reserved):
+            return overlapping
+        slots = (self.time + np.arange(self.horizon)) % self.horizon
+        for ts, position in enumerate(self.reserved[handle, slots].tolist()):
+            if position == -1:
+                continue
+            for other_ts in range(max(0, ts - window), min(self.horizon, ts + window + 1)):
+                overlapping.update(self.get_holders(position, other_ts))
+        overlapping.discard(handle)
+        return overlapping
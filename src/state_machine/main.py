@@ -41,7 +41,7 @@ def main(args):
 	                    1. / 4.: 0.25}  # Slow freight train
 
 	observation_builder = GraphObsForRailEnv(bfs_depth=args.bfs_depth,
-	                                         predictor=ShortestPathPredictorForRailEnv(max_depth=args.prediction_depth))
+	                                         predictor=ShortestPathPredictorForRailEnv(max_depth=args.prediction_depth, show_predictions=True))
 
 	# Construct the environment with the given observation, generators, predictors, and stochastic data
 	env = RailEnv(width=args.width,
@@ -85,7 +85,8 @@ def main(args):
 			
 			for a in range(env.get_num_agents()):
 				shortest_path_prediction = observation_builder.cells_sequence[a]
-				state_machine_action, is_alternative = act(args, env, a, state[a], shortest_path_prediction) # State machine picks action
+				state_machine_action, is_alternative = act(args, env, a, state[a], shortest_path_prediction,
+				                                           observation_builder.reservations) # State machine picks action
 				if not is_alternative:
 					railenv_action = observation_builder.choose_railenv_action(a, state_machine_action)
 				else:
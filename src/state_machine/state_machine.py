@@ -6,11 +6,18 @@ from flatland.envs.rail_env import RailEnvActions
 from flatland.envs.agent_utils import RailAgentStatus
 from flatland.core.grid.grid4_utils import get_new_position, get_direction, Grid4TransitionsEnum
 from flatland.core.transition_map import GridTransitionMap
+from flatland.core.grid.grid_utils import coordinate_to_position
+
+from src.rail_cache import get_rail_cache
 
 
 # TODO Add check for status
 # Only for active agents
-def act(args, env, a, state, prediction):
+def act(args, env, a, state, prediction, reservations=None):
+	"""
+	:param reservations: ReservationTable of the observation builder, if given alternatives leading to cells reserved by
+	other agents at the next step are discarded (unless there is no other alternative)
+	"""
 	
 	agent = env.agents[a]
 	if agent.status == RailAgentStatus.READY_TO_DEPART:
@@ -32,10 +39,11 @@ def act(args, env, a, state, prediction):
 		if state[args.prediction_depth*4] < state[args.prediction_depth*4 + 1]:
 			return 0, 0
 		else:
-			possible_transitions = env.rail.get_transitions(*agent_virtual_position,
-			                                                agent.direction)  # Build list of possible branching directions from cell
+			# Build list of possible branching directions from cell
+			possible_transitions = get_rail_cache(env.rail).transitions[agent_virtual_position][agent.direction]
 			if np.count_nonzero(possible_transitions) > 1:
-				actions = find_alternative(env, possible_transitions, agent_virtual_position, agent.direction, prediction)
+				actions = find_alternative(env, possible_transitions, agent_virtual_position, agent.direction, prediction,
+				                           a, reservations)
 				# Pick one of those
 				return np.random.choice(actions), 1
 			else:
@@ -44,10 +52,11 @@ def act(args, env, a, state, prediction):
 	# Case 3 
 	elif state[0] == 1 and state[args.prediction_depth] == 1:
 		
-		possible_transitions = env.rail.get_transitions(*agent_virtual_position,
-		                                                agent.direction)  # Build list of possible branching directions from cell
+		# Build list of possible branching directions from cell
+		possible_transitions = get_rail_cache(env.rail).transitions[agent_virtual_position][agent.direction]
 		if np.count_nonzero(possible_transitions) > 1:
-			actions = find_alternative(env, possible_transitions, agent_virtual_position, agent.direction, prediction)
+			actions = find_alternative(env, possible_transitions, agent_virtual_position, agent.direction, prediction,
+			                           a, reservations)
 			# Pick one of those
 			return np.random.choice(actions), 1
 		else:
@@ -55,7 +64,7 @@ def act(args, env, a, state, prediction):
 			# Stop
 			return 1, 0
 	
-def find_alternative(env, possible_transitions, agent_pos, agent_dir, prediction):
+def find_alternative(env, possible_transitions, agent_pos, agent_dir, prediction, handle=None, reservations=None):
 	# Approccio naive - se non mi trovo su un fork mi blocco
 	# altrimenti si potrebbe far ricalcolare uno shortestpath che non consideri il binario su cui si trova il treno che confligge
 
@@ -71,6 +80,12 @@ def find_alternative(env, possible_transitions, agent_pos, agent_dir, prediction
 		# Compute all possible moves except the ones of the shortest path
 		next_cell = (prediction[0][0], prediction[0][1])
 		neighbours = [n for n in neighbours if next_cell not in n]
+		# Prefer cells that no other agent is predicted to hold at the next step
+		if reservations is not None:
+			free_neighbours = [n for n in neighbours if reservations.is_free(
+				int(coordinate_to_position(env.width, [n[0]])[0]), 0, handle)]
+			if free_neighbours:
+				neighbours = free_neighbours
 		
 		actions = [get_action_for_move(
 			agent_pos,
@@ -104,12 +119,13 @@ def get_action_for_move(
 	Optional[RailEnvActions]
 		the action (if direct transition possible) or None.
 	"""
-	possible_transitions = rail.get_transitions(*agent_position, agent_direction)
+	rail_cache = get_rail_cache(rail)
+	possible_transitions = rail_cache.transitions[agent_position][agent_direction]
 	num_transitions = np.count_nonzero(possible_transitions)
 	# Start from the current orientation, and see which transitions are available;
 	# organize them as [left, forward, right], relative to the current orientation
 	# If only one transition is possible, the forward branch is aligned with it.
-	if rail.is_dead_end(agent_position):
+	if rail_cache.dead_end_mask[agent_position]:
 		valid_action = RailEnvActions.MOVE_FORWARD
 		new_direction = (agent_direction + 2) % 4
 		if possible_transitions[new_direction]:
@@ -0,0 +1,145 @@
+"""
+Switch graph of a rail: straight segments of rail are contracted into edges between switches, dead-ends and targets.
+It is built once per map (e.g. at reset()) and shared by predictors, observation builders and controllers, so that path
+searches and conflict reasoning visit tens of nodes instead of every (cell, direction) of the grid.
+"""
+
+import weakref
+
+import numpy as np
+
+from src.rail_cache import get_rail_cache, MOVEMENTS
+
+# Switch graph of each rail (GridTransitionMap), dropped together with the rail
+_switch_graphs = weakref.WeakKeyDictionary()
+
+
+class SwitchGraph:
+    """
+    Directed graph where nodes are cells that are switches, dead-ends or targets and edges are the rail segments
+    between them, stored in CSR format (edges leaving node u are the ones in range indptr[u]:indptr[u + 1]):
+
+    - node_cells: np.array of shape (num_nodes, 2), (row, column) of each node
+    - node_ids: np.array of shape (height, width), id of the node in each cell, -1 if the cell is not a node
+    - indptr: np.array of shape (num_nodes + 1,)
+    - edge_sources, edge_targets: np.array of shape (num_edges,), ids of source and target node of each edge
+    - edge_exit_directions: np.array of shape (num_edges,), direction in which the edge leaves the source node
+    - edge_entry_directions: np.array of shape (num_edges,), direction in which the edge enters the target node
+    - edge_lengths: np.array of shape (num_edges,), number of cells of the edge, i.e. steps from source to target
+    - cells_indptr: np.array of shape (num_edges + 1,), cells of edge e are cells[cells_indptr[e]:cells_indptr[e + 1]]
+    - cells: np.array of shape (num_edge_cells, 3), (row, column, direction) of the cells of each edge in the order they
+    are walked, from the first cell after the source node to the target node (included), where direction is the
+    direction of the agent when it enters the cell
+    - waypoint_edges: np.array of shape (height, width, 4), edge walked by an agent in cell (row, column) with the given
+    direction, -1 for nodes and for waypoints not on any edge
+    - waypoint_offsets: np.array of shape (height, width, 4), index of the waypoint in the cells of its edge
+    """
+
+    def __init__(self, rail, targets=()):
+        rail_cache = get_rail_cache(rail)
+        # Keep a reference to the grid to detect when the rail is replaced
+        self.grid = rail.grid
+        self.targets = frozenset(tuple(target) for target in targets)
+        self.height, self.width = rail_cache.height, rail_cache.width
+        self.transitions = rail_cache.transitions
+
+        is_node = rail_cache.switch_mask | rail_cache.dead_end_mask
+        for target in self.targets:
+            is_node[target] = rail_cache.rail_mask[target]
+        self.node_cells = np.argwhere(is_node)
+        self.node_ids = np.full((self.height, self.width), -1, dtype=int)
+        self.node_ids[is_node] = np.arange(len(self.node_cells))
+
+        edge_sources, edge_exit_directions, segments = self._find_segments(rail_cache)
+        self.edge_sources = np.array(edge_sources, dtype=int)
+        self.edge_exit_directions = np.array(edge_exit_directions, dtype=int)
+        self.edge_lengths = np.array([len(segment) for segment in segments], dtype=int)
+        self.indptr = np.zeros(len(self.node_cells) + 1, dtype=int)
+        np.cumsum(np.bincount(self.edge_sources, minlength=len(self.node_cells)), out=self.indptr[1:])
+        self.cells_indptr = np.zeros(len(segments) + 1, dtype=int)
+        np.cumsum(self.edge_lengths, out=self.cells_indptr[1:])
+        self.cells = np.array([cell for segment in segments for cell in segment], dtype=int).reshape((-1, 3))
+
+        last_cells = self.cells[self.cells_indptr[1:] - 1]
+        self.edge_targets = self.node_ids[last_cells[:, 0], last_cells[:, 1]]
+        self.edge_entry_directions = last_cells[:, 2]
+
+        # Index waypoints of the edges (but the target node) to find the edge an agent is walking
+        self.waypoint_edges = np.full((self.height, self.width, 4), -1, dtype=int)
+        self.waypoint_offsets = np.full((self.height, self.width, 4), -1, dtype=int)
+        edge_ids = np.repeat(np.arange(len(segments)), self.edge_lengths)
+        offsets = np.arange(len(self.cells)) - self.cells_indptr[edge_ids]
+        inner = self.node_ids[self.cells[:, 0], self.cells[:, 1]] == -1
+        rows, cols, directions = self.cells[inner].T
+        self.waypoint_edges[rows, cols, directions] = edge_ids[inner]
+        self.waypoint_offsets[rows, cols, directions] = offsets[inner]
+
+    def _find_segments(self, rail_cache):
+        """
+        Walk the rail from each exit of each node until another node is reached.
+        Segments that never reach a node (e.g. broken rails) are discarded.
+        :param rail_cache: RailCache of the rail
+        :return: lists of source node, exit direction and cells (row, column, direction) of each segment
+        """
+        # Exit direction of each waypoint with exactly one possible transition, -1 otherwise
+        num_exits = self.transitions.sum(axis=3)
+        next_directions = np.where(num_exits == 1, np.argmax(self.transitions, axis=3), -1).tolist()
+        node_exits = self.transitions[self.node_cells[:, 0], self.node_cells[:, 1]].any(axis=1)
+        node_ids = self.node_ids.tolist()
+        movements = MOVEMENTS.tolist()
+        max_length = int(rail_cache.rail_mask.sum()) * 4
+
+        edge_sources, edge_exit_directions, segments = [], [], []
+        for node, (row, col) in enumerate(self.node_cells.tolist()):
+            for exit_direction in np.flatnonzero(node_exits[node]).tolist():
+                segment = []
+                direction = exit_direction
+                position = (row, col)
+                for _ in range(max_length):
+                    position = (position[0] + movements[direction][0], position[1] + movements[direction][1])
+                    if not (0 <= position[0] < self.height and 0 <= position[1] < self.width):
+                        break
+                    segment.append((position[0], position[1], direction))
+                    if node_ids[position[0]][position[1]] != -1:
+                        edge_sources.append(node)
+                        edge_exit_directions.append(exit_direction)
+                        segments.append(segment)
+                        break
+                    direction = next_directions[position[0]][position[1]][direction]
+                    if direction == -1:
+                        break
+        return edge_sources, edge_exit_directions, segments
+
+    def out_edges(self, node, direction):
+        """
+        Edges that an agent in the node cell, with the given direction, can take.
+        :param node: node id
+        :param direction: direction of the agent
+        :return: np.array of edge ids
+        """
+        row, col = self.node_cells[node]
+        edges = np.arange(self.indptr[node], self.indptr[node + 1])
+        return edges[self.transitions[row, col, direction, self.edge_exit_directions[edges]] == 1]
+
+    def edge_cells(self, edge):
+        """
+        :param edge: edge id
+        :return: np.array of shape (edge_length, 3), (row, column, direction) of the cells of the edge
+        """
+        return self.cells[self.cells_indptr[edge]:self.cells_indptr[edge + 1]]
+
+
+def get_switch_graph(rail, targets=()):
+    """
+    Return the SwitchGraph of the rail, it is built the first time that this rail (or a new grid or set of targets for
+    this rail) is seen, e.g. at the first reset() of an episode on a new map, and then shared by all its users.
+    :param rail: GridTransitionMap of the env
+    :param targets: targets of the agents, that are nodes of the graph
+    :return: SwitchGraph
+    """
+    switch_graph = _switch_graphs.get(rail)
+    if switch_graph is None or switch_graph.grid is not rail.grid or \
+            switch_graph.targets != frozenset(tuple(target) for target in targets):
+        switch_graph = SwitchGraph(rail, targets)
+        _switch_graphs[rail] = switch_graph
+    return switch_graph
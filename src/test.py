@@ -42,7 +42,7 @@ speed_ration_map = {1.: 0.25,  # Fast passenger train
 schedule_generator = sparse_schedule_generator(speed_ration_map)
 
 prediction_depth = 40
-observation_builder = GraphObsForRailEnv(bfs_depth=4, predictor=ShortestPathPredictorForRailEnv(max_depth=prediction_depth))
+observation_builder = GraphObsForRailEnv(bfs_depth=4, predictor=ShortestPathPredictorForRailEnv(max_depth=prediction_depth, show_predictions=True))
 
 state_size = prediction_depth * 4 + 4
 network_action_size = 2
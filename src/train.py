@@ -18,7 +18,6 @@ from flatland.envs.malfunction_generators import malfunction_from_params#, Malfu
 from src.graph_observations import GraphObsForRailEnv
 from src.local_observations import LocalObsForRailEnv
 from src.predictions import ShortestPathPredictorForRailEnv
-from src.utils import preprocess_obs
 
 from src.dueling_double_dqn import Agent
 from src.print_info import print_info
@@ -59,7 +58,8 @@ def main(args):
         
         prediction_depth = args.prediction_depth
         bfs_depth = args.bfs_depth
-        observation_builder = GraphObsForRailEnv(bfs_depth=bfs_depth, predictor=ShortestPathPredictorForRailEnv(max_depth=prediction_depth))
+        observation_builder = GraphObsForRailEnv(bfs_depth=bfs_depth, predictor=ShortestPathPredictorForRailEnv(max_depth=prediction_depth, incremental=True),
+                                                 only_action_required=True)
         state_size = args.prediction_depth * 3 + 4 # TODO
         network_action_size = 2  # {follow path, stop}
         railenv_action_size = 5  # The RailEnv possible actions
@@ -67,7 +67,8 @@ def main(args):
 
     elif args.observation_builder == 'LocalObsForRailEnv':
         
-        observation_builder = LocalObsForRailEnv(args.view_semiwidth, args.view_height, args.offset)
+        # Observations are already preprocessed, as (in_channels, view_width, view_height) views of a float32 buffer
+        observation_builder = LocalObsForRailEnv(args.view_semiwidth, args.view_height, args.offset, batched=True)
         #state_size = (2 * args.view_semiwidth + 1) * args.height
         state_size = 16 + 5 + 2 # state_size == in_channels
         railenv_action_size = 5
@@ -118,8 +119,9 @@ def main(args):
         # Normalize obs, only for LocalObs now
         elif args.observation_builder == 'LocalObsForRailEnv':       
             for a in range(env.get_num_agents()):
-                if obs[a]:
-                    agent_obs[a] = preprocess_obs(obs[a])
+                if obs[a] is not None:
+                    # Copied since the buffer of the observation builder is overwritten at each step
+                    agent_obs[a] = obs[a].copy()
                     agent_obs_buffer[a] = agent_obs[a].copy()
         
         score = 0
@@ -190,8 +192,8 @@ def main(args):
                 # Preprocessing and normalization
                 if args.observation_builder == 'GraphObsForRailEnv':
                     agent_obs[a] = next_obs[a].copy()
-                if args.observation_builder == 'LocalObsForRailEnv' and next_obs[a]:
-                    agent_obs[a] = preprocess_obs(next_obs[a])
+                if args.observation_builder == 'LocalObsForRailEnv' and next_obs[a] is not None:
+                    agent_obs[a] = next_obs[a].copy()
                 
                 score += all_rewards[a] / env.get_num_agents()  # Update score
 
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import OrderedDict
 from flatland.envs.agent_utils import RailAgentStatus
 from flatland.core.grid.grid_utils import coordinate_to_position, distance_on_rail
 '''
@@ -79,6 +80,64 @@ def assign_priority(env, env_agent, conflict):
         return priority
     
 
+def is_action_required(env_agent):
+    """
+    Same condition used by RailEnv to fill info['action_required'], namely the agent is ready to depart or it is active
+    and at the beginning of a cell.
+    :param env_agent: 
+    :return: True if the agent has to pick an action
+    """
+    return env_agent.status == RailAgentStatus.READY_TO_DEPART or (
+            env_agent.status == RailAgentStatus.ACTIVE and
+            np.isclose(env_agent.speed_data['position_fraction'], 0.0, rtol=1e-03))
+
+
+class LRUCache:
+    """
+    Dict with at most maxsize entries, when full the least recently used entry is dropped.
+    Hits and misses of get() are counted, e.g. to check that cached results are actually reused.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        :param key: 
+        :return: the value stored for key (that becomes the most recently used), default if key is not cached
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """
+        Store value for key, dropping the least recently used entry if the cache is full.
+        :param key: 
+        :param value: 
+        :return: 
+        """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
 def preprocess_obs(obs):
     """Preprocess local observations before feeding to the conv network"""
     # Concatenate info about rail, agent and targets